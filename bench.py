@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+⏱ Бенчмарк Birthday Bot на синтетических Excel файлах
+
+Генерирует ростеры от 1 тыс. до 1 млн строк (смешанные форматы дат,
+пустые строки, несколько листов), замеряет каждую стадию - чтение и
+разбор Excel, снимок, индекс, запросы и форматирование ответов - и
+пишет результаты в JSON. С --baseline сравнивает с сохраненным
+результатом и завершается с кодом 1, если что-то заметно замедлилось.
+
+    python bench.py --sizes 1000,10000,100000 --output bench.json
+    python bench.py --sizes 1000,10000 --baseline bench.json
+"""
+
+import os
+import argparse
+import json
+import logging
+import platform
+import random
+import sys
+import tempfile
+import time
+from datetime import date, datetime
+
+import bot
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+MAX_SIZE = 1000000
+DATA_DIR = '.bench'
+
+logger = logging.getLogger('bench')
+
+# ================== ГЕНЕРАТОР РОСТЕРА ==================
+SURNAMES = ['Иванов', 'Петров', 'Сидоров', 'Смирнов', 'Кузнецов', 'Попов', 'Васильев',
+            'Соколов', 'Михайлов', 'Новиков', 'Федоров', 'Морозов', 'Волков', 'Алексеев']
+FIRST_NAMES = ['Александр', 'Мария', 'Дмитрий', 'Анна', 'Сергей', 'Елена', 'Андрей',
+               'Ольга', 'Алексей', 'Татьяна', 'Иван', 'Наталья', 'Михаил', 'Юлия']
+DEPARTMENTS = ['Бухгалтерия', 'Склад', 'Продажи', 'ИТ', 'Логистика', 'Кадры']
+
+EXCEL_EPOCH = date(1899, 12, 30)
+
+def random_cell_date(rng, birthday):
+    """Дата рождения в одном из форматов, которые встречаются в реальных файлах"""
+    kind = rng.random()
+    if kind < 0.45:
+        return datetime(birthday.year, birthday.month, birthday.day)
+    if kind < 0.65:
+        return birthday.strftime('%d.%m.%Y')
+    if kind < 0.75:
+        return birthday.strftime('%Y-%m-%d')
+    if kind < 0.82:
+        return birthday.strftime('%d/%m/%Y')
+    if kind < 0.90:
+        return (birthday - EXCEL_EPOCH).days  # серийный номер Excel
+    if kind < 0.95:
+        return f" {birthday.strftime('%d.%m.%Y')} "  # с пробелами по краям
+    return None  # дата не заполнена
+
+def generate_roster(path, rows, seed=0):
+    """Записать синтетический xlsx: лист без нужных колонок, затем ростер из rows строк"""
+    import openpyxl
+
+    rng = random.Random(seed)
+    workbook = openpyxl.Workbook(write_only=True)
+
+    # Первый лист без ФИО и дат - бот должен его пропустить
+    summary = workbook.create_sheet('Сводка')
+    summary.append(['Отдел', 'Численность'])
+    for department in DEPARTMENTS:
+        summary.append([department, rng.randint(5, 500)])
+
+    sheet = workbook.create_sheet('Сотрудники')
+    sheet.append(['№', 'Табельный номер', 'ФИО', 'Отдел', 'Дата рождения'])
+    start = date(1955, 1, 1).toordinal()
+    end = date(2005, 12, 31).toordinal()
+    for i in range(rows):
+        if rng.random() < 0.02:
+            sheet.append([])  # пустая строка посреди таблицы
+            continue
+        birthday = date.fromordinal(rng.randint(start, end))
+        name = f"{rng.choice(SURNAMES)} {rng.choice(FIRST_NAMES)} {i}"
+        sheet.append([i + 1, 100000 + i, name, rng.choice(DEPARTMENTS), random_cell_date(rng, birthday)])
+
+    # Пустые строки в конце листа, как после удаления сотрудников
+    for _ in range(5):
+        sheet.append([])
+
+    archive = workbook.create_sheet('Архив')
+    archive.append(['ФИО', 'Дата увольнения'])
+
+    tmp_path = f"{path}.tmp"
+    workbook.save(tmp_path)
+    os.replace(tmp_path, path)
+
+def roster_file(rows, seed, data_dir):
+    """Путь к синтетическому файлу; генерируется, если его еще нет"""
+    os.makedirs(data_dir, exist_ok=True)
+    path = os.path.join(data_dir, f"roster_{rows}_{seed}.xlsx")
+    if not os.path.exists(path):
+        started = time.perf_counter()
+        generate_roster(path, rows, seed)
+        logger.info(f"Сгенерирован {path} за {time.perf_counter() - started:.1f} с")
+    return path
+
+# ================== ЗАМЕРЫ ==================
+def measure(func, repeat):
+    """Лучшее время из repeat запусков: (секунды, результат последнего запуска)"""
+    best = None
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def sample_pages(pages, count=50):
+    """До count страниц /all, равномерно от первой до последней"""
+    if len(pages) <= count:
+        return pages
+    step = (len(pages) - 1) / (count - 1)
+    return [pages[round(i * step)] for i in range(count)]
+
+def bench_size(path, repeat):
+    """Замерить все стадии на одном файле: {стадия: секунды}"""
+    timings = {}
+
+    timings['read'], found = measure(lambda: bot.read_xlsx_columns(path), repeat)
+    sheet, header, names, dates, fio_idx, date_idx = found[0]
+    meta = dict(sheet=sheet, columns=header, total_rows=len(names),
+                fio_col=header[fio_idx], date_col=header[date_idx])
+
+    def parse():
+        roster = bot.build_roster_plain(names, dates, **meta)
+        if roster is None:
+            roster = bot.build_roster(bot.pd.Series(names, dtype=object),
+                                      bot.pd.Series(dates, dtype=object), **meta)
+        return roster
+
+    parse()  # импорт pandas не считаем временем разбора
+    timings['parse'], _ = measure(parse, repeat)
+    timings['load_excel_data'], roster = measure(lambda: bot.load_excel_data(path), repeat)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        snapshot = os.path.join(tmp, 'roster.snapshot')
+        timings['snapshot_write'], _ = measure(lambda: bot.write_snapshot(roster, snapshot, 'bench'), repeat)
+        timings['snapshot_read'], _ = measure(lambda: bot.read_snapshot(snapshot, 'bench'), repeat)
+
+    timings['index'], _ = measure(lambda: bot.BirthdayIndex(roster), repeat)
+
+    # Запросы идут через кэш ростера, как в боте
+    bot.roster_cache.watched = True
+    bot.roster_cache.swap(roster, None, None)
+    bot.get_birthday_index()
+
+    timings['today'], _ = measure(bot.get_today_birthdays, repeat)
+    timings['upcoming_7'], _ = measure(lambda: bot.get_upcoming_birthdays(7), repeat)
+    timings['upcoming_30'], upcoming = measure(lambda: bot.get_upcoming_birthdays(30), repeat)
+    timings['format_birthday_list'], _ = measure(lambda: bot.format_birthday_list(upcoming), repeat)
+    timings['render_week'], _ = measure(bot.render_week, repeat)
+    timings['render_count'], _ = measure(bot.render_count, repeat)
+    timings['render_all'], _ = measure(bot.render_all, repeat)
+    timings['name_index'], name_index = measure(lambda: bot.NameIndex().sync(roster), repeat)
+    timings['find_prefix'], _ = measure(lambda: name_index.search('Ив'), repeat)
+    timings['find_fuzzy'], _ = measure(lambda: name_index.search('Смирнв Алекс'), repeat)
+
+    pages = sample_pages(bot.all_pages(bot.get_birthday_index()))
+    total, _ = measure(lambda: [bot.render_all_page(month, page) for month, page, _, _ in pages], repeat)
+    timings['render_all_page'] = total / len(pages) if pages else 0.0
+
+    return {'people': len(roster), 'timings': timings}
+
+def run_benchmarks(sizes, repeat, seed, data_dir):
+    """Все размеры по очереди: {размер: {people, timings}}"""
+    results = {}
+    for rows in sizes:
+        path = roster_file(rows, seed, data_dir)
+        logger.info(f"Бенчмарк {rows} строк...")
+        results[str(rows)] = bench_size(path, repeat)
+    return results
+
+# ================== СРАВНЕНИЕ С БАЗОВОЙ ЛИНИЕЙ ==================
+def compare(results, baseline, threshold, min_time):
+    """Стадии, которые медленнее базовой линии больше чем на threshold.
+
+    Стадии быстрее min_time секунд в обоих замерах не сравниваются -
+    у них в разнице больше шума, чем сигнала.
+    """
+    regressions = []
+    for size, current in results.items():
+        base = baseline.get('results', {}).get(size)
+        if base is None:
+            continue
+        for stage, seconds in current['timings'].items():
+            base_seconds = base['timings'].get(stage)
+            if base_seconds is None or max(seconds, base_seconds) < min_time:
+                continue
+            ratio = seconds / base_seconds if base_seconds else float('inf')
+            if ratio > 1 + threshold:
+                regressions.append((size, stage, base_seconds, seconds, ratio))
+    return regressions
+
+def format_table(results, baseline=None):
+    """Результаты таблицей (мс), с отношением к базовой линии если она есть"""
+    lines = []
+    for size, current in results.items():
+        base = (baseline or {}).get('results', {}).get(size, {}).get('timings', {})
+        lines.append(f"{size} строк ({current['people']} человек):")
+        for stage, seconds in current['timings'].items():
+            line = f"  {stage:<22}{seconds * 1000:>12.3f} мс"
+            if stage in base and base[stage]:
+                line += f"  x{seconds / base[stage]:.2f}"
+            lines.append(line)
+    return "\n".join(lines)
+
+def parse_sizes(value):
+    sizes = [int(size) for size in value.split(',') if size.strip()]
+    for size in sizes:
+        if not 1 <= size <= MAX_SIZE:
+            raise argparse.ArgumentTypeError(f"размер должен быть от 1 до {MAX_SIZE}: {size}")
+    return sizes
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк Birthday Bot")
+    parser.add_argument('--sizes', type=parse_sizes, default=DEFAULT_SIZES,
+                        help="число строк через запятую (до 1000000), по умолчанию 1000,10000,100000")
+    parser.add_argument('--repeat', type=int, default=3, help="запусков каждой стадии (берется лучший)")
+    parser.add_argument('--seed', type=int, default=0, help="seed генератора ростера")
+    parser.add_argument('--data-dir', default=DATA_DIR, help="куда сохранять сгенерированные файлы")
+    parser.add_argument('--output', help="записать результаты в JSON")
+    parser.add_argument('--baseline', help="JSON с базовой линией для сравнения")
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help="допустимое замедление относительно базовой линии (0.25 = 25%%)")
+    parser.add_argument('--min-time', type=float, default=0.001,
+                        help="не сравнивать стадии быстрее стольких секунд")
+    parser.add_argument('--verbose', action='store_true', help="показывать лог бота")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    if not args.verbose:
+        logging.getLogger(bot.__name__).setLevel(logging.WARNING)
+
+    results = run_benchmarks(args.sizes, max(1, args.repeat), args.seed, args.data_dir)
+    report = {
+        'meta': {
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': args.repeat,
+            'seed': args.seed,
+        },
+        'results': results,
+    }
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    print(format_table(results, baseline))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=1)
+        logger.info(f"Результаты записаны в {args.output}")
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold, args.min_time)
+        for size, stage, base_seconds, seconds, ratio in regressions:
+            print(f"❌ {size} строк, {stage}: {base_seconds * 1000:.3f} -> {seconds * 1000:.3f} мс (x{ratio:.2f})")
+        if regressions:
+            return 1
+        print(f"✅ Замедлений больше {args.threshold:.0%} нет")
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
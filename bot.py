@@ -1,25 +1,116 @@
 #!/usr/bin/env python3
 """
 🎂 Birthday Bot с чтением Excel файла "Штат_чистый.xlsx"
+
+Ростер можно собрать из нескольких книг и листов (EXCEL_SOURCES):
+файлы разбираются параллельно и объединяются без повторов.
 """
 
-import os
-import pandas as pd
-from datetime import datetime, timedelta
-import schedule
 import time
+STARTUP_STARTED = time.perf_counter()
+
+import os
+import argparse
+import copy
+import cProfile
+import pstats
+import csv
+import io
+import importlib
+import inspect
+import hashlib
+import hmac
+import json
+import mmap
+import struct
+import bisect
+import numbers
+import sys
+from array import array
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import calendar
+import fnmatch
+import functools
+import glob
+import ctypes
+import ctypes.util
+import select
+import sqlite3
+import tempfile
+import heapq
+import queue
+from contextlib import contextmanager
+from datetime import date, datetime, time as dt_time, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import threading
 import logging
 import telebot
+from telebot import types
+from telebot.formatting import escape_markdown
 import re
 
+# Время старта по фазам (для отчета о запуске)
+startup_timings = {'imports': time.perf_counter() - STARTUP_STARTED}
+
 # ================== НАСТРОЙКИ ==================
-BOT_TOKEN = os.environ['BOT_TOKEN']
+BOT_TOKEN = os.environ.get('BOT_TOKEN', '')
 ADMIN_CHAT_ID = os.environ.get('ADMIN_CHAT_ID', '')
 EXCEL_FILE = "Штат_чистый.xlsx"
+# Файлы и маски через запятую, например: Штат_чистый.xlsx,отделы/*.xlsx
+EXCEL_SOURCES = os.environ.get('EXCEL_SOURCES', EXCEL_FILE)
+EXCEL_WORKERS = int(os.environ.get('EXCEL_WORKERS', '0'))  # процессов разбора файлов; 0 - по числу ядер
+# Снимок разобранного файла для быстрого старта ('0' - отключить)
+USE_SNAPSHOT = os.environ.get('ROSTER_SNAPSHOT', '1') != '0'
+SNAPSHOT_FILE = os.environ.get('SNAPSHOT_FILE', EXCEL_FILE + '.snapshot')
 NOTIFICATION_TIME = "09:00"  # 09:00 утра по UTC
+NOTIFICATION_TZ = "UTC"  # часовой пояс по умолчанию для подписчиков
+SCHEDULER_MAX_SLEEP = 30  # секунд: как быстро планировщик замечает перевод часов
+# Слежение за Excel файлом ('0' - перечитывать при запросах, как раньше)
+WATCH_ROSTER = os.environ.get('WATCH_ROSTER', '1') != '0'
+WATCH_DEBOUNCE = float(os.environ.get('WATCH_DEBOUNCE', '2'))  # секунд без изменений до перечитывания
+WATCH_POLL_INTERVAL = float(os.environ.get('WATCH_POLL_INTERVAL', '5'))  # если inotify недоступен
+# Режим работы: polling (TeleBot), async (AsyncTeleBot, нужен aiohttp) или webhook
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+ROSTER_WORKERS = int(os.environ.get('ROSTER_WORKERS', '2'))
+EXPORT_WORKERS = int(os.environ.get('EXPORT_WORKERS', '2'))  # одновременных выгрузок /export
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', '64'))
+ALL_PAGE_SIZE = 40  # человек на одной странице /all
+FIND_LIMIT = 10  # результатов /find в ответе
+FIND_SIMILARITY = 0.35  # минимальная похожесть слов по триграммам (0..1)
+# Вебхук: встроенный HTTP сервер принимает обновления от Telegram
+WEBHOOK_HOST = os.environ.get('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', '8080'))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/webhook')
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')  # https://адрес-бота (без пути); пусто - setWebhook не вызывается
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')  # X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', '8'))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', '256'))  # при переполнении - 503
+WEBHOOK_MAX_BODY = 1024 * 1024  # байт: обновления Telegram намного меньше, больше - 413 без чтения тела
+# Подписчики ежедневного отчета и рассылка
+SUBSCRIBERS_FILE = os.environ.get('SUBSCRIBERS_FILE', 'subscribers.json')
+BROADCAST_WORKERS = int(os.environ.get('BROADCAST_WORKERS', '8'))
+BROADCAST_RATE = float(os.environ.get('BROADCAST_RATE', '25'))  # сообщений в секунду на всех
+BROADCAST_CHAT_INTERVAL = float(os.environ.get('BROADCAST_CHAT_INTERVAL', '1.0'))  # секунд между сообщениями в один чат
+BROADCAST_RETRIES = int(os.environ.get('BROADCAST_RETRIES', '5'))
+# Очередь отчетов (SQLite): какие отчеты сформированы и кому доставлены
+OUTBOX_FILE = os.environ.get('OUTBOX_FILE', 'outbox.sqlite3')
+OUTBOX_BATCH = int(os.environ.get('OUTBOX_BATCH', '50'))  # сообщений на одну запись результатов
+OUTBOX_LEASE = 600  # секунд: после этого захват рассылки другим процессом считается прерванным
+OUTBOX_KEEP_DAYS = 30
+# Адрес Bot API, например локальный тестовый сервер: http://127.0.0.1:8081/bot{0}/{1}
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', '')
+# Метрики Prometheus на http://METRICS_HOST:METRICS_PORT/metrics ('0' - выключены)
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '0'))
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+# Профилирование по команде /profile (только админ)
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')  # куда /profile сохраняет .prof
+PROFILE_TOP = 12  # горячих точек в ответе /profile
 
 # Инициализация бота
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL
 bot = telebot.TeleBot(BOT_TOKEN)
 
 # Настройка логирования
@@ -29,518 +120,3539 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+class LazyModule:
+    """Модуль, который импортируется при первом обращении к атрибуту"""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            started = time.perf_counter()
+            self._module = importlib.import_module(self._name)
+            logger.info(f"Импорт {self._name}: {(time.perf_counter() - started) * 1000:.0f} мс")
+        return getattr(self._module, attr)
+
+# pandas нужен только для разбора Excel - при загрузке из снимка он не импортируется
+pd = LazyModule('pandas')
+
+# ================== МЕТРИКИ ==================
+# Границы корзин гистограмм, секунды (getUpdates ждет до ~25 с)
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+METRIC_HELP = {
+    'bot_handler_seconds': "Время обработки команды",
+    'bot_handler_errors_total': "Исключения в обработчиках команд",
+    'bot_phase_seconds': "Длительность фаз загрузки ростера (чтение, разбор, снимок, хэш, индексы)",
+    'bot_telegram_request_seconds': "Время запроса к Bot API",
+    'bot_telegram_errors_total': "Ошибки запросов к Bot API (code - код ответа или network)",
+    'bot_scheduler_lag_seconds': "Опоздание доставки отчета: от запланированного времени до завершения рассылки",
+    'bot_cache_hits_total': "Попадания в кэш",
+    'bot_cache_misses_total': "Промахи кэша",
+    'bot_cache_entries': "Записей в кэше",
+    'bot_roster_reloads_total': "Перезагрузки ростера",
+    'bot_roster_version': "Версия загруженного ростера",
+    'bot_roster_people': "Людей в ростере",
+    'bot_scheduled_chats': "Чатов в расписании ежедневного отчета",
+    'bot_startup_seconds': "Длительность фаз запуска",
+    'bot_webhook_updates_total': "Обновления, пришедшие на вебхук (result - принято, отклонено...)",
+    'bot_webhook_queue_seconds': "Время ожидания обновления в очереди вебхука",
+    'bot_webhook_queue_depth': "Обновлений в очереди вебхука",
+    'bot_outbox_messages': "Сообщения в очереди отчетов по состояниям",
+}
+
+class Histogram:
+    """Гистограмма Prometheus: число наблюдений по корзинам и их сумма"""
+
+    __slots__ = ('counts', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(METRIC_BUCKETS) + 1)  # последняя - +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(METRIC_BUCKETS, value)] += 1
+        self.sum += value
+
+def format_labels(labels, **extra):
+    """Метки в формате Prometheus: {name="value",...}"""
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for _, value in items)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(items, escaped)) + '}'
+
+class Metrics:
+    """Счетчики и гистограммы в памяти процесса.
+
+    Пока метрики выключены, observe() и inc() сразу возвращаются, так
+    что замеры в обработчиках почти ничего не стоят. Значения, которые
+    уже считают другие объекты (кэши, планировщик), не дублируются -
+    их собирают функции-коллекторы в момент запроса /metrics.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._histograms = {}  # имя -> {метки: Histogram}
+        self._counters = {}    # имя -> {метки: значение}
+        self._collectors = []
+
+    def observe(self, name, value, **labels):
+        """Добавить наблюдение в гистограмму"""
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name, value=1, **labels):
+        """Увеличить счетчик"""
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def collector(self, func):
+        """Зарегистрировать коллектор: func() -> [(имя, тип, [(метки, значение), ...]), ...]"""
+        self._collectors.append(func)
+        return func
+
+    def render(self):
+        """Все метрики в текстовом формате Prometheus"""
+        lines = []
+
+        def header(name, kind):
+            lines.append(f"# HELP {name} {METRIC_HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        with self._lock:
+            histograms = {name: {key: (list(h.counts), h.sum) for key, h in series.items()}
+                          for name, series in self._histograms.items()}
+            counters = {name: dict(series) for name, series in self._counters.items()}
+
+        for name, series in sorted(histograms.items()):
+            header(name, 'histogram')
+            for key, (counts, total) in sorted(series.items()):
+                cumulative = 0
+                for bound, count in zip(METRIC_BUCKETS + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{format_labels(key, le=bound)} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(key)} {total}")
+                lines.append(f"{name}_count{format_labels(key)} {cumulative}")
+
+        for name, series in sorted(counters.items()):
+            header(name, 'counter')
+            for key, value in sorted(series.items()):
+                lines.append(f"{name}{format_labels(key)} {value}")
+
+        for collect in self._collectors:
+            try:
+                collected = collect()
+            except Exception as e:
+                logger.error(f"Ошибка сбора метрик {collect.__name__}: {e}")
+                continue
+            for name, kind, samples in collected:
+                header(name, kind)
+                for labels, value in samples:
+                    lines.append(f"{name}{format_labels(sorted(labels.items()))} {value}")
+
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics(enabled=METRICS_PORT > 0)
+
+# Фазы текущего потока для /profile: {фаза: секунды}
+_phase_trace = threading.local()
+
+@contextmanager
+def phase(name, metric=True):
+    """Замерить фазу работы: with phase('parse'): ...
+
+    metric=False - фаза только для отчета /profile: bot_phase_seconds
+    описывает загрузку ростера, запросы и рендер туда не пишутся.
+    """
+    trace = getattr(_phase_trace, 'phases', None)
+    if not (metric and metrics.enabled) and trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        if metric and metrics.enabled:
+            metrics.observe('bot_phase_seconds', elapsed, phase=name)
+        if trace is not None:
+            trace[name] = trace.get(name, 0.0) + elapsed
+
+@contextmanager
+def trace_phases():
+    """Собрать время фаз, пройденных в этом потоке: with trace_phases() as phases: ..."""
+    _phase_trace.phases = {}
+    try:
+        yield _phase_trace.phases
+    finally:
+        _phase_trace.phases = None
+
+def timed(command):
+    """Декоратор обработчика команды: время и исключения по команде.
+
+    Работает и с обычными функциями, и с корутинами (async-режим).
+    """
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if not metrics.enabled:
+                    return await func(*args, **kwargs)
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                except Exception:
+                    metrics.inc('bot_handler_errors_total', command=command)
+                    raise
+                finally:
+                    metrics.observe('bot_handler_seconds', time.perf_counter() - started, command=command)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not metrics.enabled:
+                return func(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                metrics.inc('bot_handler_errors_total', command=command)
+                raise
+            finally:
+                metrics.observe('bot_handler_seconds', time.perf_counter() - started, command=command)
+        return wrapper
+    return decorator
+
+def observe_telegram_call(method_name, started, error):
+    """Учесть вызов Bot API: время и ошибку (если была)"""
+    metrics.observe('bot_telegram_request_seconds', time.perf_counter() - started, method=method_name)
+    if error is not None:
+        code = str(getattr(error, 'error_code', None) or 'network')
+        metrics.inc('bot_telegram_errors_total', method=method_name, code=code)
+
+def instrument_telegram_api():
+    """Замерять все запросы синхронного клиента к Bot API"""
+    make_request = telebot.apihelper._make_request
+
+    def timed_request(token, method_name, method='get', params=None, files=None):
+        started = time.perf_counter()
+        error = None
+        try:
+            return make_request(token, method_name, method, params=params, files=files)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            observe_telegram_call(method_name, started, error)
+
+    telebot.apihelper._make_request = timed_request
+
+def instrument_async_telegram_api():
+    """То же для асинхронного клиента (telebot.asyncio_helper)"""
+    process_request = telebot.asyncio_helper._process_request
+
+    async def timed_request(token, url, method='get', params=None, files=None, **kwargs):
+        started = time.perf_counter()
+        error = None
+        try:
+            return await process_request(token, url, method, params=params, files=files, **kwargs)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            observe_telegram_call(url, started, error)
+
+    telebot.asyncio_helper._process_request = timed_request
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """GET /metrics для Prometheus"""
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # опросы Prometheus не пишем в лог
+
+def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    """Запустить HTTP сервер метрик в фоновом потоке"""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info(f"📈 Метрики: http://{host}:{server.server_port}/metrics")
+    return server
+
+# ================== РОСТЕР ==================
+class Person:
+    """Легкое представление одной записи ростера (создается по требованию)"""
+
+    __slots__ = ('_roster', '_i')
+
+    def __init__(self, roster, i):
+        self._roster = roster
+        self._i = i
+
+    @property
+    def name(self):
+        return self._roster.names[self._i]
+
+    @property
+    def month(self):
+        return self._roster.months[self._i]
+
+    @property
+    def day(self):
+        return self._roster.days[self._i]
+
+    @property
+    def year(self):
+        return self._roster.years[self._i]
+
+    @property
+    def row(self):
+        return self._roster.rows[self._i]
+
+    @property
+    def source(self):
+        """Источник записи: {'file', 'sheet', ...}"""
+        return self._roster.sources[self._roster.source_ids[self._i]]
+
+    @property
+    def birthday(self):
+        """Дата рождения (datetime) или None"""
+        month = self._roster.months[self._i]
+        if not month:
+            return None
+        return datetime(self._roster.years[self._i], month, self._roster.days[self._i])
+
+class BirthdayHit:
+    """Человек с ближайшим днем рождения"""
+
+    __slots__ = ('person', 'age', 'days_until')
+
+    def __init__(self, person, age, days_until=0):
+        self.person = person
+        self.age = age
+        self.days_until = days_until
+
+    @property
+    def name(self):
+        return self.person.name
+
+    @property
+    def birthday(self):
+        return self.person.birthday
+
+class CompactRoster:
+    """Ростер в упакованных массивах.
+
+    Месяц, день, год рождения и строка Excel хранятся в array, имена - в
+    одном кортеже интернированных строк. Месяц 0 означает, что дата
+    рождения не указана. Person создаются только при обращении.
+
+    Каждая запись помечена номером источника (файл и лист) в source_ids;
+    описания источников - в sources. Ростер из одного листа - один
+    источник, собранный из meta.
+    """
+
+    def __init__(self, names, months, days, years, rows,
+                 sheet=None, columns=(), total_rows=0, fio_col=None, date_col=None,
+                 file=None, sources=None, source_ids=None, duplicates=0):
+        self.names = tuple(sys.intern(name) for name in names)
+        self.months = array('B', months)
+        self.days = array('B', days)
+        self.years = array('H', years)
+        self.rows = array('I', rows)
+        self.sheet = sheet
+        self.columns = list(columns)
+        self.total_rows = total_rows
+        self.fio_col = fio_col
+        self.date_col = date_col
+        if sources is None:
+            sources = [{'file': file, 'sheet': sheet, 'columns': self.columns, 'total_rows': total_rows,
+                        'fio_col': fio_col, 'date_col': date_col}]
+        self.sources = sources
+        self.source_ids = array('H', source_ids if source_ids is not None else bytes(2 * len(self.names)))
+        self.duplicates = duplicates  # записей, выброшенных как повторы из других источников
+        self.dated_count = len(self.months) - self.months.count(0)
+
+    @property
+    def files(self):
+        """Файлы, из которых собран ростер (по порядку)"""
+        return list(dict.fromkeys(source['file'] for source in self.sources if source['file']))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.names)
+        if not 0 <= i < len(self.names):
+            raise IndexError(i)
+        return Person(self, i)
+
+    def __iter__(self):
+        for i in range(len(self.names)):
+            yield Person(self, i)
+
 # ================== РАБОТА С EXCEL ==================
-def load_excel_data():
-    """Загрузить данные из Excel файла"""
+# Форматы дат в текстовых ячейках
+DATE_FORMATS = ['%d.%m.%Y', '%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y', '%d.%m.%y']
+DATE_FORMAT_SAMPLE = 200  # сколько значений смотреть для выбора формата
+EXCEL_EPOCH = '1899-12-30'  # нулевой день серийных дат Excel
+EXCEL_SERIAL_MAX = 2958465  # 31.12.9999
+
+def parse_name_column(column):
+    """Нормализовать колонку ФИО: Series строк и маска непустых"""
+    names = column.astype(str).str.strip()
+    mask = column.notna() & (names != '') & (names != 'nan')
+    return names, mask
+
+def first_token(strings):
+    """Убрать лишние пробелы и время, если есть"""
+    return strings.str.strip().str.split(n=1).str[0].dropna()
+
+def infer_date_format(strings):
+    """Упорядочить DATE_FORMATS по числу распознанных значений в выборке"""
+    sample = first_token(strings.head(DATE_FORMAT_SAMPLE))
+    scores = []
+    for position, fmt in enumerate(DATE_FORMATS):
+        parsed = pd.to_datetime(sample, format=fmt, errors='coerce')
+        scores.append((-int(parsed.notna().sum()), position, fmt))
+    return [fmt for _, _, fmt in sorted(scores)]
+
+def apply_date_format(result, strings, fmt):
+    """Разобрать строки форматом fmt, записать в result, вернуть нераспознанные"""
+    # Дат рождения намного меньше, чем строк: разбираем только уникальные значения
+    uniques = pd.Index(strings.unique())
+    parsed = pd.to_datetime(uniques, format=fmt, errors='coerce')
+    parsed = pd.Series(parsed[uniques.get_indexer(strings)], index=strings.index)
+    ok = parsed.notna()
+    result[parsed[ok].index] = parsed[ok]
+    return strings[~ok]
+
+def parse_birthday_column(column):
+    """Векторный разбор колонки дат рождения.
+
+    Ячейки-даты берутся как есть, числа считаются серийными датами Excel,
+    строки разбираются форматом, выбранным по выборке, а остаток -
+    следующими форматами. Возвращает Series datetime64 (NaT - нет даты).
+    """
+    if pd.api.types.is_datetime64_any_dtype(column):
+        return column.dt.normalize()
+
+    result = pd.Series(pd.NaT, index=column.index, dtype='datetime64[ns]')
+    present = column.notna()
+    if not present.any():
+        return result
+
+    if pd.api.types.is_numeric_dtype(column):
+        serials = column.where(present & column.between(1, EXCEL_SERIAL_MAX))
+        return pd.to_datetime(serials, unit='D', origin=EXCEL_EPOCH, errors='coerce').dt.normalize()
+
+    # Раскладываем ячейки по типам; для однородной колонки - без проверки каждой ячейки
+    values = column[present]
+    kind = pd.api.types.infer_dtype(values, skipna=True)
+    if kind == 'string':
+        texts, serials, dates = values, values[:0], values[:0]
+    elif kind in ('datetime', 'datetime64', 'date'):
+        texts, serials, dates = values[:0], values[:0], values
+    else:
+        texts = values[values.map(lambda v: isinstance(v, str))]
+        serials = values[values.map(lambda v: isinstance(v, numbers.Real) and not isinstance(v, bool))]
+        dates = values[values.map(lambda v: isinstance(v, (datetime, date)))]
+
+    if not dates.empty:
+        parsed = pd.to_datetime(dates, errors='coerce').dt.normalize()
+        result[parsed.index] = parsed
+
+    if not serials.empty:
+        serials = pd.to_numeric(serials, errors='coerce')
+        serials = serials.where(serials.between(1, EXCEL_SERIAL_MAX))
+        parsed = pd.to_datetime(serials, unit='D', origin=EXCEL_EPOCH, errors='coerce').dt.normalize()
+        result[parsed.index] = parsed
+
+    if not texts.empty:
+        formats = infer_date_format(texts)
+        # Чистая колонка разбирается одним проходом лучшим форматом
+        texts = apply_date_format(result, texts, formats[0])
+        if not texts.empty:
+            texts = first_token(texts)
+            for fmt in formats:
+                if texts.empty:
+                    break
+                texts = apply_date_format(result, texts, fmt)
+
+    return result
+
+def build_roster(name_column, date_column, **meta):
+    """Собрать CompactRoster из колонок ФИО и дат"""
+    names, mask = parse_name_column(name_column)
+    birthdays = parse_birthday_column(date_column)
+
+    # Непустые ячейки дат, которые не удалось распознать - одним сообщением
+    failed = mask & date_column.notna() & birthdays.isna()
+    if failed.any():
+        # +2 потому что Excel нумерация с 1 и заголовок
+        examples = [f"{idx + 2}: '{date_column[idx]}'" for idx in failed[failed].index[:10]]
+        logger.warning(f"Не удалось распознать {int(failed.sum())} дат, например: {', '.join(examples)}")
+
+    names = names[mask]
+    birthdays = birthdays[mask]
+    return CompactRoster(
+        names.tolist(),
+        birthdays.dt.month.fillna(0).astype('uint8').tolist(),
+        birthdays.dt.day.fillna(0).astype('uint8').tolist(),
+        birthdays.dt.year.fillna(0).astype('uint16').tolist(),
+        (names.index + 2).tolist(),
+        **meta
+    )
+
+# Ключевые слова в заголовках колонок
+FIO_KEYWORDS = ['фио', 'ф.и.о', 'имя', 'name', 'сотрудник']
+DATE_KEYWORDS = ['дата', 'др', 'birth', 'рожден']
+# Именно дата рождения, а не любая дата ("Дата увольнения"); "др" - отдельным словом ("адрес" не подходит)
+BIRTH_DATE_RE = re.compile(r'рожд|birth|\bдр\b')
+
+def is_birth_column(header):
+    """Заголовок явно про дату рождения"""
+    return header is not None and BIRTH_DATE_RE.search(str(header).lower()) is not None
+
+def find_columns(headers):
+    """Найти колонки ФИО и даты рождения по заголовкам: (индекс ФИО, индекс даты)"""
+    fio_columns = []
+    date_columns = []
+    
+    for i, col in enumerate(headers):
+        if col is None:
+            continue
+        col_str = str(col).lower()
+        
+        # Ищем колонки с ФИО
+        if any(word in col_str for word in FIO_KEYWORDS):
+            fio_columns.append(i)
+        
+        # Ищем колонки с датой рождения
+        if any(word in col_str for word in DATE_KEYWORDS):
+            date_columns.append(i)
+    
+    logger.info(f"Найдены колонки ФИО: {[headers[i] for i in fio_columns]}")
+    logger.info(f"Найдены колонки дат: {[headers[i] for i in date_columns]}")
+    
+    if not fio_columns or not date_columns:
+        return None, None
+    # Берем первую колонку ФИО и первую колонку дат: сначала дата рождения,
+    # затем любая "дата" и только потом прочие совпадения ("др" есть и в "адрес")
+    birth_columns = [i for i in date_columns if is_birth_column(headers[i])]
+    dated_columns = [i for i in date_columns if 'дата' in str(headers[i]).lower()]
+    return fio_columns[0], (birth_columns or dated_columns or date_columns)[0]
+
+def select_sheets(candidates):
+    """Листы для ростера из [(лист, заголовки, индекс ФИО, индекс даты), ...].
+
+    Берутся все листы, где колонка дат - явно дата рождения. Если таких
+    нет, как раньше берется первый лист с любой датой: иначе лист вроде
+    "Архив" с "Датой увольнения" попал бы в дни рождения.
+    """
+    birth = [candidate for candidate in candidates if is_birth_column(candidate[1][candidate[3]])]
+    for sheet, header, _, date_idx in candidates:
+        if birth and not is_birth_column(header[date_idx]):
+            logger.info(f"Лист '{getattr(sheet, 'title', sheet)}' пропущен: колонка '{header[date_idx]}' - не дата рождения")
+    return birth or candidates[:1]
+
+def read_xlsx_columns(path):
+    """Потоково прочитать из xlsx только колонки ФИО и даты.
+
+    Сначала по каждому листу читается одна строка заголовка, затем по
+    листам, выбранным select_sheets() - только две нужные колонки, строка
+    за строкой. Возвращает список (лист, заголовки, имена, даты, индекс
+    ФИО, индекс даты) - пустой, если подходящих листов нет.
+    """
+    import openpyxl
+
+    found = []
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
     try:
-        # Пробуем разные возможные названия листов
-        sheet_names = pd.ExcelFile(EXCEL_FILE).sheet_names
-        logger.info(f"Найденные листы: {sheet_names}")
+        logger.info(f"Найденные листы: {workbook.sheetnames}")
         
-        # Пробуем прочитать первый лист или ищем по ключевым словам
-        for sheet in sheet_names:
+        candidates = []
+        for sheet in workbook.worksheets:
             try:
-                df = pd.read_excel(EXCEL_FILE, sheet_name=sheet)
-                logger.info(f"Лист '{sheet}': {len(df)} строк, {len(df.columns)} колонок")
+                header = list(next(sheet.iter_rows(min_row=1, max_row=1, values_only=True), ()))
+                while header and header[-1] is None:
+                    header.pop()
+                logger.info(f"Лист '{sheet.title}': {len(header)} колонок")
                 
-                # Ищем колонки с ФИО и датой рождения
-                fio_columns = []
-                date_columns = []
-                
-                for col in df.columns:
-                    col_str = str(col).lower()
-                    
-                    # Ищем колонки с ФИО
-                    if any(word in col_str for word in ['фио', 'ф.и.о', 'имя', 'name', 'сотрудник']):
-                        fio_columns.append(col)
-                    
-                    # Ищем колонки с датой рождения
-                    if any(word in col_str for word in ['дата', 'др', 'birth', 'рожден']):
-                        date_columns.append(col)
-                
-                logger.info(f"Найдены колонки ФИО: {fio_columns}")
-                logger.info(f"Найдены колонки дат: {date_columns}")
+                fio_idx, date_idx = find_columns(header)
+                if fio_idx is not None:
+                    candidates.append((sheet, header, fio_idx, date_idx))
+            except Exception as e:
+                logger.error(f"Ошибка чтения листа '{sheet.title}': {e}")
+        
+        for sheet, header, fio_idx, date_idx in select_sheets(candidates):
+            try:
+                names = []
+                dates = []
+                width = max(fio_idx, date_idx) + 1
+                for row in sheet.iter_rows(min_row=2, max_col=width, values_only=True):
+                    names.append(row[fio_idx] if len(row) > fio_idx else None)
+                    dates.append(row[date_idx] if len(row) > date_idx else None)
                 
-                if fio_columns and date_columns:
-                    # Берем первую найденную колонку каждого типа
-                    fio_col = fio_columns[0]
-                    date_col = date_columns[0]
-                    
-                    logger.info(f"Используем колонки: ФИО='{fio_col}', Дата='{date_col}'")
-                    
-                    # Создаем список людей
-                    people = []
-                    
-                    for idx, row in df.iterrows():
-                        try:
-                            name = str(row[fio_col]).strip()
-                            date_str = str(row[date_col]).strip()
-                            
-                            # Пропускаем пустые строки
-                            if pd.isna(name) or name == 'nan' or not name:
-                                continue
-                            
-                            # Пытаемся преобразовать дату
-                            birthday = None
-                            
-                            # Пробуем разные форматы дат
-                            if not pd.isna(date_str) and date_str != 'nan':
-                                try:
-                                    # Пробуем парсить как datetime
-                                    if isinstance(date_str, str):
-                                        # Убираем лишние пробелы и время если есть
-                                        date_str_clean = date_str.split()[0] if ' ' in date_str else date_str
-                                        
-                                        # Пробуем разные форматы
-                                        for fmt in ['%d.%m.%Y', '%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y', '%d.%m.%y']:
-                                            try:
-                                                birthday = datetime.strptime(date_str_clean, fmt)
-                                                break
-                                            except:
-                                                continue
-                                    
-                                    # Если date_str уже datetime
-                                    elif isinstance(date_str, pd.Timestamp):
-                                        birthday = date_str.to_pydatetime()
-                                    elif isinstance(date_str, datetime):
-                                        birthday = date_str
-                                    
-                                except Exception as e:
-                                    logger.warning(f"Не удалось распарсить дату '{date_str}' для {name}: {e}")
-                                    birthday = None
-                            
-                            people.append({
-                                'name': name,
-                                'birthday': birthday,
-                                'row': idx + 2  # +2 потому что Excel нумерация с 1 и заголовок
-                            })
-                            
-                        except Exception as e:
-                            logger.warning(f"Ошибка в строке {idx}: {e}")
-                            continue
-                    
-                    logger.info(f"Загружено {len(people)} человек из Excel")
-                    return people, df, fio_col, date_col
+                # Пустые строки в конце листа не считаем
+                while names and names[-1] is None and dates[-1] is None:
+                    names.pop()
+                    dates.pop()
                 
+                found.append((sheet.title, header, names, dates, fio_idx, date_idx))
+            
             except Exception as e:
-                logger.error(f"Ошибка чтения листа '{sheet}': {e}")
+                logger.error(f"Ошибка чтения листа '{sheet.title}': {e}")
                 continue
+    finally:
+        workbook.close()
+    
+    return found
+
+def read_excel_columns(path):
+    """То же для прочих форматов (xls) через pandas: заголовок, затем две колонки"""
+    sheet_names = pd.ExcelFile(path).sheet_names
+    logger.info(f"Найденные листы: {sheet_names}")
+    
+    candidates = []
+    for sheet in sheet_names:
+        try:
+            header = list(pd.read_excel(path, sheet_name=sheet, nrows=0).columns)
+            logger.info(f"Лист '{sheet}': {len(header)} колонок")
+            
+            fio_idx, date_idx = find_columns(header)
+            if fio_idx is not None:
+                candidates.append((sheet, header, fio_idx, date_idx))
+        except Exception as e:
+            logger.error(f"Ошибка чтения листа '{sheet}': {e}")
+    
+    found = []
+    for sheet, header, fio_idx, date_idx in select_sheets(candidates):
+        try:
+            df = pd.read_excel(path, sheet_name=sheet, header=None, skiprows=1,
+                               usecols=sorted({fio_idx, date_idx}))
+            names = df[fio_idx].tolist()
+            dates = df[date_idx].tolist()
+            found.append((sheet, header, names, dates, fio_idx, date_idx))
+        
+        except Exception as e:
+            logger.error(f"Ошибка чтения листа '{sheet}': {e}")
+            continue
+    
+    return found
+
+def build_roster_plain(names, dates, **meta):
+    """Собрать ростер без pandas, если все ячейки дат уже даты.
+
+    openpyxl отдает ячейки с форматом даты как datetime, так что для
+    аккуратно заполненного файла разбирать нечего. Если встретилась
+    строка или число - возвращает None, и нужен build_roster().
+    """
+    kept_names, months, days, years, rows = [], [], [], [], []
+    for i, (name, value) in enumerate(zip(names, dates)):
+        if value is not None and not isinstance(value, (datetime, date)):
+            return None
+        if name is None:
+            continue
+        name = str(name).strip()
+        if not name or name == 'nan':
+            continue
+        
+        kept_names.append(name)
+        rows.append(i + 2)  # +2 потому что Excel нумерация с 1 и заголовок
+        if value is None:
+            months.append(0)
+            days.append(0)
+            years.append(0)
+        else:
+            months.append(value.month)
+            days.append(value.day)
+            years.append(value.year)
+    
+    return CompactRoster(kept_names, months, days, years, rows, **meta)
+
+def load_excel_data(path=None, missing=None):
+    """Загрузить данные из Excel файла (все листы с колонками ФИО и даты)
+
+    None - файл не прочитан; missing - файл прочитан, но листов ростера в нем нет.
+    """
+    path = path or EXCEL_FILE
+    try:
+        with phase('read'):
+            if path.lower().endswith(('.xlsx', '.xlsm')):
+                found = read_xlsx_columns(path)
+            else:
+                found = read_excel_columns(path)
         
-        logger.error("Не удалось найти подходящие колонки в Excel файле")
-        return [], None, None, None
+        if not found:
+            if missing is None:
+                logger.error(f"Не удалось найти подходящие колонки в файле {path}")
+            return missing
+        
+        rosters = []
+        for sheet, header, names, dates, fio_idx, date_idx in found:
+            fio_col = header[fio_idx]
+            date_col = header[date_idx]
+            logger.info(f"Лист '{sheet}': колонки ФИО='{fio_col}', Дата='{date_col}'")
+            
+            meta = dict(sheet=sheet, columns=header, total_rows=len(names),
+                        fio_col=fio_col, date_col=date_col, file=path)
+            with phase('parse'):
+                roster = build_roster_plain(names, dates, **meta)
+                if roster is None:
+                    roster = build_roster(pd.Series(names, dtype=object), pd.Series(dates, dtype=object), **meta)
+            rosters.append(roster)
+        
+        roster = merge_rosters(rosters)
+        logger.info(f"Загружено {len(roster)} человек из {path}")
+        return roster
         
     except Exception as e:
-        logger.error(f"Ошибка загрузки Excel файла: {e}")
-        return [], None, None, None
+        logger.error(f"Ошибка загрузки Excel файла {path}: {e}")
+        return None
 
-def get_today_birthdays():
-    """Получить дни рождения на сегодня"""
-    people, _, _, _ = load_excel_data()
-    today = datetime.now()
+# ================== НЕСКОЛЬКО ИСТОЧНИКОВ ==================
+def source_patterns(spec=None):
+    """Пути и маски из строки через запятую"""
+    return [pattern.strip() for pattern in (spec or EXCEL_SOURCES).split(',') if pattern.strip()]
+
+def is_pattern(path):
+    return any(char in path for char in '*?[')
+
+def resolve_sources(spec=None):
+    """Существующие файлы ростера по путям и маскам (по порядку, без повторов)"""
+    paths = []
+    for pattern in source_patterns(spec):
+        if is_pattern(pattern):
+            paths.extend(sorted(glob.glob(pattern, recursive=True)))
+        elif os.path.exists(pattern):
+            paths.append(pattern)
+    # ~$Книга.xlsx - файл блокировки открытой в Excel книги, а не ростер
+    return list(dict.fromkeys(path for path in paths if not os.path.basename(path).startswith('~$')))
+
+def source_label(source):
+    """Название источника для ответов: имя файла без расширения и лист"""
+    if not source['file']:
+        return str(source['sheet'])
+    stem = os.path.splitext(os.path.basename(source['file']))[0]
+    return f"{stem} / {source['sheet']}"
+
+def merge_rosters(rosters):
+    """Объединить ростеры нескольких источников в один.
+
+    Источники нумеруются подряд. Запись, которая уже встречалась в
+    другом источнике (то же ФИО без учета регистра и знаков и та же
+    дата рождения), пропускается; повторы внутри одного листа остаются.
+    """
+    if len(rosters) == 1:
+        return rosters[0]
     
-    result = []
-    for person in people:
-        if person['birthday']:
-            # Сравниваем только день и месяц
-            if (person['birthday'].month == today.month and 
-                person['birthday'].day == today.day):
-                
-                # Вычисляем возраст
-                age = today.year - person['birthday'].year
-                result.append({
-                    'name': person['name'],
-                    'birthday': person['birthday'],
-                    'age': age
-                })
+    names, months, days, years, rows, source_ids = [], [], [], [], [], []
+    sources = []
+    first_source = {}
+    duplicates = 0
+    for roster in rosters:
+        offset = len(sources)
+        sources.extend(roster.sources)
+        duplicates += roster.duplicates
+        for entry in zip(roster.names, roster.months, roster.days, roster.years, roster.rows, roster.source_ids):
+            name, month, day, year, row, source = entry
+            source += offset
+            key = (' '.join(normalize_words(name)), month, day, year)
+            if first_source.setdefault(key, source) != source:
+                duplicates += 1
+                continue
+            names.append(name)
+            months.append(month)
+            days.append(day)
+            years.append(year)
+            rows.append(row)
+            source_ids.append(source)
     
-    return result
+    if duplicates:
+        logger.info(f"Пропущено {duplicates} повторов из разных источников")
+    first = rosters[0]
+    return CompactRoster(names, months, days, years, rows,
+                         sheet=first.sheet, columns=first.columns,
+                         total_rows=sum(roster.total_rows for roster in rosters),
+                         fio_col=first.fio_col, date_col=first.date_col,
+                         sources=sources, source_ids=source_ids, duplicates=duplicates)
 
-def get_tomorrow_birthdays():
-    """Получить дни рождения на завтра"""
-    people, _, _, _ = load_excel_data()
-    tomorrow = datetime.now() + timedelta(days=1)
+def load_sources(paths):
+    """Разобрать файлы ростера (несколько - параллельно в пуле процессов) и объединить"""
+    if not paths:
+        logger.error(f"Файлы ростера не найдены: {EXCEL_SOURCES}")
+        return None
     
-    result = []
-    for person in people:
-        if person['birthday']:
-            if (person['birthday'].month == tomorrow.month and 
-                person['birthday'].day == tomorrow.day):
-                
-                age = tomorrow.year - person['birthday'].year
-                result.append({
-                    'name': person['name'],
-                    'birthday': person['birthday'],
-                    'age': age
-                })
+    # False - книга без листов ростера (сводная таблица под той же маской)
+    load = functools.partial(load_excel_data, missing=False)
+    workers = min(len(paths), EXCEL_WORKERS or os.cpu_count() or 1)
+    if workers > 1:
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                rosters = list(pool.map(load, paths))
+        except (OSError, BrokenProcessPool) as e:
+            logger.warning(f"Пул процессов недоступен ({e}), разбираем файлы по очереди")
+            rosters = [load(path) for path in paths]
+    else:
+        rosters = [load(path) for path in paths]
     
-    return result
+    # Битый или недописанный файл не должен молча убрать своих людей из ростера:
+    # вся загрузка считается неудачной, и в кэше остается прежняя версия
+    failed = [path for path, roster in zip(paths, rosters) if roster is None]
+    if failed:
+        logger.error(f"Не распознаны файлы: {', '.join(failed)}")
+        return None
+    
+    skipped = [path for path, roster in zip(paths, rosters) if roster is False]
+    if skipped:
+        logger.warning(f"Пропущены файлы без листов ростера: {', '.join(skipped)}")
+        rosters = [roster for roster in rosters if roster is not False]
+        if not rosters:
+            return None
+    
+    with phase('merge'):
+        roster = merge_rosters(rosters)
+    if len(rosters) > 1:
+        logger.info(f"Ростер собран из {len(rosters)} файлов ({len(roster.sources)} листов): {len(roster)} человек")
+    return roster
 
-def get_after_tomorrow_birthdays():
-    """Получить дни рождения на послезавтра"""
-    people, _, _, _ = load_excel_data()
-    after_tomorrow = datetime.now() + timedelta(days=2)
+# ================== СНИМОК РОСТЕРА ==================
+# Формат: магия, длина JSON-заголовка, заголовок, затем сырые массивы
+# months, days, years, rows, source_ids и имена в UTF-8 через \0
+SNAPSHOT_MAGIC = b'BDAYSNP2'
+# Версия правил разбора Excel: увеличить при любом изменении поиска колонок,
+# листов или разбора дат - снимки старой версии будут пересобраны
+SNAPSHOT_PARSER_VERSION = 1
+_SNAPSHOT_ARRAYS = (('months', 'B'), ('days', 'B'), ('years', 'H'), ('rows', 'I'), ('source_ids', 'H'))
+
+def write_snapshot(roster, path, source_digest):
+    """Записать снимок ростера (атомарно, через временный файл)"""
+    names = '\0'.join(roster.names).encode('utf-8')
+    header = json.dumps({
+        'source_digest': source_digest,
+        'parser_version': SNAPSHOT_PARSER_VERSION,
+        'count': len(roster),
+        'byteorder': sys.byteorder,
+        'itemsizes': {name: getattr(roster, name).itemsize for name, _ in _SNAPSHOT_ARRAYS},
+        'names_size': len(names),
+        'sheet': roster.sheet,
+        'columns': [str(col) for col in roster.columns],
+        'total_rows': roster.total_rows,
+        'fio_col': None if roster.fio_col is None else str(roster.fio_col),
+        'date_col': None if roster.date_col is None else str(roster.date_col),
+        'sources': [dict(source, columns=[str(col) for col in source['columns']],
+                         fio_col=None if source['fio_col'] is None else str(source['fio_col']),
+                         date_col=None if source['date_col'] is None else str(source['date_col']))
+                    for source in roster.sources],
+        'duplicates': roster.duplicates,
+    }, ensure_ascii=False).encode('utf-8')
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        for name, _ in _SNAPSHOT_ARRAYS:
+            getattr(roster, name).tofile(f)
+        f.write(names)
+    os.replace(tmp_path, path)
+    logger.info(f"Снимок ростера записан: {path} ({len(roster)} записей)")
+
+def read_snapshot(path, source_digest=None):
+    """Прочитать снимок; None если его нет, он поврежден, от другого файла или другой версии разбора"""
+    try:
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+                return None
+            offset = len(SNAPSHOT_MAGIC)
+            (header_size,) = struct.unpack_from('<I', mm, offset)
+            offset += 4
+            header = json.loads(mm[offset:offset + header_size].decode('utf-8'))
+            offset += header_size
+
+            if source_digest is not None and header['source_digest'] != source_digest:
+                return None
+            if header.get('parser_version') != SNAPSHOT_PARSER_VERSION:
+                logger.info(f"Снимок {path} собран другой версией разбора, пересобираем")
+                return None
+            if header['byteorder'] != sys.byteorder:
+                return None
+
+            count = header['count']
+            columns = {}
+            for name, typecode in _SNAPSHOT_ARRAYS:
+                values = array(typecode)
+                if values.itemsize != header['itemsizes'][name]:
+                    return None
+                size = values.itemsize * count
+                values.frombytes(mm[offset:offset + size])
+                offset += size
+                columns[name] = values
+
+            names_bytes = mm[offset:offset + header['names_size']]
+            names = names_bytes.decode('utf-8').split('\0') if count else []
+            if len(names) != count:
+                return None
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, struct.error) as e:
+        logger.warning(f"Не удалось прочитать снимок {path}: {e}")
+        return None
+
+    return CompactRoster(
+        names, columns['months'], columns['days'], columns['years'], columns['rows'],
+        sheet=header['sheet'], columns=header['columns'], total_rows=header['total_rows'],
+        fio_col=header['fio_col'], date_col=header['date_col'],
+        sources=header['sources'], source_ids=columns['source_ids'], duplicates=header['duplicates']
+    )
+
+def load_roster(source_digest=None):
+    """Загрузить ростер: из снимка, если он соответствует файлам, иначе из Excel"""
+    if USE_SNAPSHOT and source_digest:
+        with phase('snapshot_read'):
+            roster = read_snapshot(SNAPSHOT_FILE, source_digest)
+        if roster is not None:
+            logger.info(f"Ростер загружен из снимка {SNAPSHOT_FILE}: {len(roster)} записей")
+            return roster
+
+    roster = load_sources(resolve_sources())
+    if USE_SNAPSHOT and source_digest and roster is not None:
+        try:
+            with phase('snapshot_write'):
+                write_snapshot(roster, SNAPSHOT_FILE, source_digest)
+        except OSError as e:
+            logger.warning(f"Не удалось записать снимок {SNAPSHOT_FILE}: {e}")
+    return roster
+
+# ================== КЭШ ДАННЫХ ==================
+def file_digest(path, chunk_size=1024 * 1024):
+    """SHA-256 содержимого файла"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def sources_digest(paths):
+    """Общий SHA-256 набора файлов: меняется при изменении, добавлении или удалении любого"""
+    h = hashlib.sha256()
+    for path in paths:
+        h.update(f"{path}\0{file_digest(path)}\n".encode('utf-8'))
+    return h.hexdigest()
+
+class RosterCache:
+    """Потокобезопасный кэш разобранных Excel файлов.
+
+    Файлы перечитываются только если они действительно изменились:
+    сначала сравниваются список файлов, их mtime и размеры, а при
+    изменении - хэш содержимого (файл могли перезаписать теми же данными).
+    """
+
+    def __init__(self, sources, loader):
+        # sources - пути и маски через запятую; loader(digest) получает общий SHA-256 файлов
+        self.sources = sources
+        self._loader = loader
+        self._lock = threading.Lock()
+        self._stat_key = None
+        self._digest = None
+        self._data = None
+        self._derived = {}
+        self._derived_lock = threading.Lock()
+        self.version = 0  # увеличивается при каждой перезагрузке
+        # Файл отслеживает RosterWatcher: запросы не проверяют файл и не перечитывают его
+        self.watched = False
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+
+    def paths(self):
+        """Файлы ростера, которые есть сейчас"""
+        return resolve_sources(self.sources)
+
+    def _stat(self):
+        keys = []
+        for path in self.paths():
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            keys.append((path, st.st_mtime_ns, st.st_size))
+        return tuple(keys) or None
+
+    def get(self):
+        """Вернуть данные, при необходимости перечитав файл"""
+        with self._lock:
+            if self._data is not None and self.watched:
+                self.hits += 1
+                return self._data
+            
+            stat_key = self._stat()
+            if self._data is not None and stat_key == self._stat_key:
+                self.hits += 1
+                return self._data
+
+            self.misses += 1
+            digest = None
+            if stat_key is not None:
+                try:
+                    with phase('digest'):
+                        digest = sources_digest([key[0] for key in stat_key])
+                except OSError as e:
+                    logger.warning(f"Не удалось прочитать {self.sources}: {e}")
+
+            if self._data is not None and digest == self._digest:
+                # Изменились только метаданные файла
+                self._stat_key = stat_key
+                return self._data
+
+            logger.info(f"Перечитываем {self.sources} (версия {self.version + 1})")
+            data = self._loader(digest)
+            self._stat_key = stat_key
+            if not is_valid_roster(data) and self._data is not None:
+                # Битый файл не заменяет рабочие данные
+                logger.error(f"Файлы {self.sources} не распознаны, оставляем версию {self.version}")
+                return self._data
+            
+            self._data = data
+            self._digest = digest
+            self.version += 1
+            self.reloads += 1
+            self._drop_stale_derived(data)
+            return self._data
+
+    def snapshot(self):
+        """Текущие (данные, stat, хэш) без проверки файла"""
+        with self._lock:
+            return self._data, self._stat_key, self._digest
+
+    def swap(self, data, stat_key, digest):
+        """Атомарно подменить данные (уже загруженные вне блокировки)"""
+        with self._lock:
+            self._data = data
+            self._stat_key = stat_key
+            self._digest = digest
+            self.version += 1
+            self.reloads += 1
+        self._drop_stale_derived(data)
+
+    def _drop_stale_derived(self, data):
+        """Забыть структуры прежних версий, чтобы старый ростер освободился"""
+        with self._derived_lock:
+            for name in [name for name, entry in self._derived.items() if entry[0] is not data]:
+                del self._derived[name]
+
+    def mark_seen(self, stat_key):
+        """Запомнить stat файлов, которые не нужно перечитывать"""
+        with self._lock:
+            self._stat_key = stat_key
+
+    def derived(self, name, builder):
+        """Структура, построенная по текущим данным - один раз на загрузку"""
+        data = self.get()
+        with self._derived_lock:
+            entry = self._derived.get(name)
+            if entry is not None and entry[0] is data:
+                return entry[1]
+            value = builder(data)
+            self._derived[name] = (data, value)
+            return value
+
+    def invalidate(self):
+        """Сбросить кэш - следующий вызов get() перечитает файл"""
+        with self._lock:
+            self._data = None
+            self._stat_key = None
+            self._digest = None
+
+    def stats(self):
+        """Счетчики попаданий/промахов/перезагрузок"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'reloads': self.reloads,
+                'version': self.version,
+            }
+
+def is_valid_roster(roster):
+    """Ростер можно использовать: файл распознан и в нем есть люди"""
+    return roster is not None and len(roster) > 0
+
+roster_cache = RosterCache(EXCEL_SOURCES, load_roster)
+
+def get_roster():
+    """Получить CompactRoster из Excel (через кэш) или None"""
+    return roster_cache.get()
+
+# ================== СЛЕЖЕНИЕ ЗА ФАЙЛОМ ==================
+class Inotify:
+    """Минимальная обертка над inotify (Linux) через ctypes"""
+
+    IN_MODIFY = 0x002
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    _EVENT = struct.Struct('iIII')
+
+    def __init__(self, patterns):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        
+        # Следим за каталогами: файл часто заменяют целиком (запись во временный + rename)
+        self._names = {}  # дескриптор каталога -> маски имен файлов в нем
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+        for directory, name in watch_targets(patterns):
+            wd = libc.inotify_add_watch(self._fd, os.fsencode(directory), mask)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                os.close(self._fd)
+                raise OSError(errno, f"inotify_add_watch {directory}")
+            self._names.setdefault(wd, []).append(name)
+
+    def wait(self, timeout=None):
+        """Дождаться события по одному из файлов; False если истек timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            ready, _, _ = select.select([self._fd], [], [], remaining)
+            if not ready:
+                return False
+            if self._read_events():
+                return True
+
+    def _read_events(self):
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return False
+        found = False
+        offset = 0
+        while offset + self._EVENT.size <= len(data):
+            wd, _, _, length = self._EVENT.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + self._EVENT.size:offset + self._EVENT.size + length].rstrip(b'\0'))
+            if any(fnmatch.fnmatchcase(name, pattern) for pattern in self._names.get(wd, ())):
+                found = True
+            offset += self._EVENT.size + length
+        return found
+
+def watch_targets(patterns):
+    """Пары (каталог, маска имени) для inotify.
+
+    Если маска есть в пути каталога (отделы/*/штат.xlsx), следим за
+    каталогами уже найденных файлов; новые каталоги заметит опрос stat.
+    """
+    targets = []
+    for pattern in patterns:
+        directory, name = os.path.split(os.path.abspath(pattern))
+        if is_pattern(directory):
+            targets.extend(os.path.split(os.path.abspath(path)) for path in glob.glob(pattern, recursive=True))
+        else:
+            targets.append((directory, name))
+    return list(dict.fromkeys(targets))
+
+def roster_entries(roster):
+    """Мультимножество (имя, дата рождения) для сравнения версий"""
+    if roster is None:
+        return Counter()
+    return Counter(zip(roster.names, roster.months, roster.days, roster.years))
+
+def roster_diff(old, new):
+    """Разница между версиями ростера: добавленные, удаленные, сменившие дату"""
+    old_entries = roster_entries(old)
+    new_entries = roster_entries(new)
+    added = list((new_entries - old_entries).elements())
+    removed = list((old_entries - new_entries).elements())
     
-    result = []
-    for person in people:
-        if person['birthday']:
-            if (person['birthday'].month == after_tomorrow.month and 
-                person['birthday'].day == after_tomorrow.day):
-                
-                age = after_tomorrow.year - person['birthday'].year
-                result.append({
-                    'name': person['name'],
-                    'birthday': person['birthday'],
-                    'age': age
-                })
+    # Одно имя и в удаленных, и в добавленных - у человека поменялась дата
+    removed_by_name = {}
+    for entry in removed:
+        removed_by_name.setdefault(entry[0], []).append(entry)
+    changed = []
+    still_added = []
+    for entry in added:
+        previous = removed_by_name.get(entry[0])
+        if previous:
+            changed.append((previous.pop(), entry))
+        else:
+            still_added.append(entry)
+    still_removed = [entry for entries in removed_by_name.values() for entry in entries]
     
-    return result
+    return {'added': still_added, 'removed': still_removed, 'changed': changed}
 
-def get_upcoming_birthdays(days=7):
-    """Получить ближайшие дни рождения"""
-    people, _, _, _ = load_excel_data()
-    today = datetime.now()
+def format_entry_date(entry):
+    """Дата рождения из записи (имя, месяц, день, год)"""
+    _, month, day, year = entry
+    return f"{day:02d}.{month:02d}.{year}" if month else "без даты"
+
+def format_roster_diff(diff, limit=20):
+    """Сообщение админу об изменениях в файле"""
+    msg = f"🔄 *Файл {EXCEL_SOURCES} обновлен*\n"
+    msg += f"Добавлено: {len(diff['added'])}, удалено: {len(diff['removed'])}, "
+    msg += f"изменена дата: {len(diff['changed'])}\n"
     
-    result = []
-    for i in range(days):
-        check_date = today + timedelta(days=i)
-        
-        for person in people:
-            if person['birthday']:
-                if (person['birthday'].month == check_date.month and 
-                    person['birthday'].day == check_date.day):
-                    
-                    age = check_date.year - person['birthday'].year
-                    result.append({
-                        'name': person['name'],
-                        'birthday': person['birthday'],
-                        'age': age,
-                        'days_until': i
-                    })
-    
-    # Сортируем по количеству дней до ДР
-    result.sort(key=lambda x: x['days_until'])
-    return result
+    if diff['added']:
+        msg += "\n*Добавлены:*\n"
+        msg += "\n".join(f"• {e[0]} - {format_entry_date(e)}" for e in diff['added'][:limit]) + "\n"
+    if diff['removed']:
+        msg += "\n*Удалены:*\n"
+        msg += "\n".join(f"• {e[0]} - {format_entry_date(e)}" for e in diff['removed'][:limit]) + "\n"
+    if diff['changed']:
+        msg += "\n*Изменена дата рождения:*\n"
+        msg += "\n".join(f"• {old[0]}: {format_entry_date(old)} → {format_entry_date(new)}"
+                          for old, new in diff['changed'][:limit]) + "\n"
+    return msg
 
-# ================== ФОРМАТИРОВАНИЕ ==================
-def format_age(age):
-    """Правильное склонение лет"""
-    if age % 10 == 1 and age % 100 != 11:
-        return f"{age} год"
-    elif 2 <= age % 10 <= 4 and (age % 100 < 10 or age % 100 >= 20):
-        return f"{age} года"
+class RosterWatcher:
+    """Фоновое слежение за Excel файлами ростера.
+
+    Ждет событие inotify (или опрашивает stat, если inotify недоступен),
+    затем ждет, пока файлы перестанут меняться (WATCH_DEBOUNCE секунд),
+    разбирает их в своем потоке и только при успехе атомарно подменяет
+    ростер в кэше. Админу отправляется список изменений.
+    """
+
+    def __init__(self, cache, loader, on_change=None):
+        self.cache = cache
+        self._loader = loader
+        self._on_change = on_change
+        self._inotify = None
+        self._thread = None
+
+    def start(self):
+        try:
+            self._inotify = Inotify(source_patterns(self.cache.sources))
+            mode = "inotify"
+        except (OSError, AttributeError) as e:
+            self._inotify = None
+            mode = f"опрос каждые {WATCH_POLL_INTERVAL:g} с ({e})"
+        
+        self.cache.watched = True
+        self._thread = threading.Thread(target=self.run, name='roster-watcher', daemon=True)
+        self._thread.start()
+        logger.info(f"Слежение за {self.cache.sources}: {mode}")
+
+    def _wait_event(self, timeout):
+        if self._inotify is not None:
+            return self._inotify.wait(timeout)
+        time.sleep(timeout)
+        return True
+
+    def _changed(self):
+        _, stat_key, _ = self.cache.snapshot()
+        return self.cache._stat() != stat_key
+
+    def _settle(self):
+        """Дождаться, пока файлы перестанут меняться (запись завершена).
+
+        Возвращает stat, когда целых WATCH_DEBOUNCE секунд не было ни событий
+        inotify, ни изменений stat: медленное копирование или сохранение в
+        несколько шагов сдвигает начало тишины.
+        """
+        last = self.cache._stat()
+        quiet_since = time.monotonic()
+        while True:
+            remaining = quiet_since + WATCH_DEBOUNCE - time.monotonic()
+            if remaining <= 0:
+                return last
+            if self._inotify is not None:
+                event = self._inotify.wait(remaining)
+            else:
+                # Без inotify stat опрашивается несколько раз за интервал
+                time.sleep(min(remaining, WATCH_DEBOUNCE / 4))
+                event = False
+            current = self.cache._stat()
+            if event or current != last:
+                last = current
+                quiet_since = time.monotonic()
+
+    def run(self):
+        while True:
+            try:
+                # Опрос stat раз в WATCH_POLL_INTERVAL страхует от пропущенных событий
+                self._wait_event(WATCH_POLL_INTERVAL)
+                if self._changed():
+                    self.reload(self._settle())
+            except Exception as e:
+                logger.error(f"Ошибка слежения за файлом: {e}")
+                time.sleep(WATCH_POLL_INTERVAL)
+
+    def reload(self, stat_key):
+        """Перечитать файлы и подменить ростер, если новые данные корректны"""
+        old, _, old_digest = self.cache.snapshot()
+        if stat_key is None:
+            logger.warning(f"Файлы {self.cache.sources} удалены, оставляем прежние данные")
+            self.cache.mark_seen(None)
+            return
+        
+        with phase('digest'):
+            digest = sources_digest([key[0] for key in stat_key])
+        if digest == old_digest:
+            self.cache.mark_seen(stat_key)
+            return
+        
+        started = time.perf_counter()
+        new = self._loader(digest)
+        if not is_valid_roster(new):
+            logger.error(f"Новые файлы {self.cache.sources} не распознаны, оставляем прежние данные")
+            self.cache.mark_seen(stat_key)
+            if self._on_change:
+                self._on_change(None)
+            return
+        
+        self.cache.swap(new, stat_key, digest)
+        logger.info(f"Ростер обновлен за {time.perf_counter() - started:.2f} с: {len(new)} записей")
+        if self._on_change:
+            self._on_change(roster_diff(old, new))
+
+def notify_roster_change(diff):
+    """Сообщить админу об обновлении файла"""
+    if not ADMIN_CHAT_ID:
+        return
+    if diff is None:
+        msg = f"⚠️ Новый файл `{EXCEL_SOURCES}` не распознан - используются прежние данные"
     else:
-        return f"{age} лет"
+        msg = format_roster_diff(diff)
+    try:
+        bot.send_message(ADMIN_CHAT_ID, msg, parse_mode='Markdown')
+    except Exception as e:
+        logger.error(f"Ошибка отправки админу: {e}")
+
+def on_roster_change(diff):
+    """Новый ростер подменен: сразу построить индексы и сообщить админу"""
+    if diff is not None:
+        warm_roster()
+    notify_roster_change(diff)
+
+roster_watcher = RosterWatcher(roster_cache, load_roster, on_roster_change)
+
+# ================== ИНДЕКС ДНЕЙ РОЖДЕНИЯ ==================
+# Смещения месяцев в високосном году: ключ дня не зависит от года
+_MONTH_OFFSETS = [0, 31, 60, 91, 121, 152, 182, 213, 244, 274, 305, 335]
+FEB28_KEY = 59
+FEB29_KEY = 60
+
+def day_key(month, day):
+    """Номер дня в високосном году (1..366)"""
+    return _MONTH_OFFSETS[month - 1] + day
+
+class BirthdayIndex:
+    """Люди с датой рождения, отсортированные по месяцу и дню.
+
+    Запрос дня или окна дней - бинарный поиск по ключам, то есть
+    O(log N + k). Окно может переходить через Новый год. Родившиеся
+    29 февраля в невисокосный год поздравляются 28 февраля.
+    sources - номера источников, если нужен индекс только по ним.
+    """
+
+    def __init__(self, roster, sources=None):
+        self._roster = roster
+        if roster is None:
+            self._order = array('I')
+            self._keys = array('H')
+            return
+        months, days = roster.months, roster.days
+        keys = [_MONTH_OFFSETS[m - 1] + d if m else 0 for m, d in zip(months, days)]
+        if sources is not None:
+            keys = [key if source in sources else 0 for key, source in zip(keys, roster.source_ids)]
+        order = sorted((i for i, key in enumerate(keys) if key), key=keys.__getitem__)
+        self._order = array('I', order)
+        self._keys = array('H', (keys[i] for i in order))
+
+    def __len__(self):
+        return len(self._order)
+
+    def window(self, start, days):
+        """Список (days_until, Person) для дней рождения в [start, start + days)"""
+        if isinstance(start, datetime):
+            start = start.date()
+        result = []
+        if days <= 0 or not self._order:
+            return result
+
+        months, days_of_month = self._roster.months, self._roster.days
+        end = start + timedelta(days=days - 1)
+        segment_start = start
+        # Окно режем на куски внутри одного календарного года
+        while segment_start <= end:
+            year = segment_start.year
+            segment_end = min(end, date(year, 12, 31))
+            leap = calendar.isleap(year)
+
+            lo = day_key(segment_start.month, segment_start.day)
+            hi = day_key(segment_end.month, segment_end.day)
+            if not leap and hi == FEB28_KEY:
+                hi = FEB29_KEY
+
+            left = bisect.bisect_left(self._keys, lo)
+            right = bisect.bisect_right(self._keys, hi)
+            for i in self._order[left:right]:
+                month, day = months[i], days_of_month[i]
+                if month == 2 and day == 29 and not leap:
+                    day = 28
+                result.append(((date(year, month, day) - start).days, Person(self._roster, i)))
+
+            segment_start = segment_end + timedelta(days=1)
+
+        return result
+
+    def on_date(self, day):
+        """Люди, у которых день рождения в указанный день"""
+        return [person for _, person in self.window(day, 1)]
+
+    def sorted_people(self, left=0, right=None):
+        """Люди с датой рождения по порядку месяц/день (позиции left..right)"""
+        for i in self._order[left:right]:
+            yield Person(self._roster, i)
+
+    def month_range(self, month):
+        """Позиции (left, right) людей, родившихся в указанном месяце"""
+        lo = _MONTH_OFFSETS[month - 1] + 1
+        hi = _MONTH_OFFSETS[month] if month < 12 else 366
+        return bisect.bisect_left(self._keys, lo), bisect.bisect_right(self._keys, hi)
+
+def build_birthday_index(roster, sources=None):
+    with phase('index'):
+        return BirthdayIndex(roster, sources)
+
+def department_sources(roster, department):
+    """Номера источников отдела: подстрока имени файла или листа без учета регистра"""
+    if roster is None:
+        return frozenset()
+    department = department.casefold()
+    return frozenset(i for i, source in enumerate(roster.sources)
+                     if department in source_label(source).casefold())
+
+_department_lock = threading.Lock()
+
+def get_birthday_index(department=None):
+    """Индекс дней рождения (строится один раз на загрузку файла и на набор источников)"""
+    if not department:
+        return roster_cache.derived('birthday_index', build_birthday_index)
+    
+    # Индексы отделов живут вместе с ростером и различаются набором источников,
+    # а не текстом запроса: "бух", "Бухгалтерия" и "бухгалт" - один индекс
+    roster, indexes = roster_cache.derived('department_indexes', lambda roster: (roster, {}))
+    sources = department_sources(roster, department)
+    with _department_lock:
+        index = indexes.get(sources)
+        if index is None:
+            index = indexes[sources] = build_birthday_index(roster, sources)
+        return index
+
+def get_birthdays_on(day_offset, today=None, department=None):
+    """Дни рождения через day_offset дней от сегодня (или от today)"""
+    check_date = (today or datetime.now()) + timedelta(days=day_offset)
+    index = get_birthday_index(department)
+    with phase('query', metric=False):
+        return [BirthdayHit(person, check_date.year - person.year)
+                for person in index.on_date(check_date)]
+
+def get_today_birthdays(today=None, department=None):
+    """Получить дни рождения на сегодня"""
+    return get_birthdays_on(0, today, department)
+
+def get_tomorrow_birthdays(today=None, department=None):
+    """Получить дни рождения на завтра"""
+    return get_birthdays_on(1, today, department)
+
+def get_after_tomorrow_birthdays(today=None, department=None):
+    """Получить дни рождения на послезавтра"""
+    return get_birthdays_on(2, today, department)
+
+def get_upcoming_birthdays(days=7, department=None):
+    """Получить ближайшие дни рождения (отсортированы по количеству дней до ДР)"""
+    today = datetime.now()
+    
+    index = get_birthday_index(department)
+    result = []
+    with phase('query', metric=False):
+        for days_until, person in index.window(today, days):
+            check_date = today + timedelta(days=days_until)
+            result.append(BirthdayHit(person, check_date.year - person.year, days_until))
+    
+    return result
+
+# ================== ПОИСК ПО ИМЕНИ ==================
+_WORD_RE = re.compile(r'[^\W_]+')
+
+def normalize_words(text):
+    """Слова для поиска: без регистра, ё -> е"""
+    return _WORD_RE.findall(text.casefold().replace('ё', 'е'))
+
+def trigrams(word):
+    """Триграммы слова с пробелами по краям (начало слова весит больше)"""
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class NameIndex:
+    """Поиск людей по словам ФИО: точное слово, префикс и похожие слова.
+
+    Слова всех имен лежат в отсортированном списке (префикс - бинарный
+    поиск) и в индексе триграмм (опечатки: Ивонов -> Иванов). Индекс
+    хранит имена, а не позиции, поэтому при перезагрузке ростера
+    пересчитываются только добавленные и удаленные имена.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._roster = None
+        self._positions = {}  # имя -> [позиции в ростере]
+        self._postings = {}   # слово -> {имена}
+        self._words = []      # отсортированные слова
+        self._trigrams = {}   # триграмма -> {слова}
+        self._name_words = {}  # имя -> его слова
+        self._repeats = {}  # имя -> сколько раз оно повторяется в ростере сверх первого
+        self.last_added = 0
+        self.last_removed = 0
+
+    def _add(self, name, new_words):
+        words = self._name_words[name] = tuple(set(normalize_words(name)))
+        for word in words:
+            names = self._postings.get(word)
+            if names is None:
+                names = self._postings[word] = set()
+                for trigram in trigrams(word):
+                    self._trigrams.setdefault(trigram, set()).add(word)
+                new_words.append(word)
+            names.add(name)
+
+    def _remove(self, name, old_words):
+        for word in self._name_words.pop(name, ()):
+            names = self._postings.get(word)
+            if names is None:
+                continue
+            names.discard(name)
+            if not names:
+                del self._postings[word]
+                for trigram in trigrams(word):
+                    words = self._trigrams[trigram]
+                    words.discard(word)
+                    if not words:
+                        del self._trigrams[trigram]
+                old_words.append(word)
+
+    def sync(self, roster):
+        """Привести индекс к ростеру (только разница с прошлым вызовом)"""
+        positions = {}
+        for i, name in enumerate(roster.names if roster is not None else ()):
+            positions.setdefault(name, []).append(i)
+        
+        with self._lock:
+            added = positions.keys() - self._positions.keys()
+            removed = self._positions.keys() - positions.keys()
+            new_words, old_words = [], []
+            for name in removed:
+                self._remove(name, old_words)
+            for name in added:
+                self._add(name, new_words)
+            
+            if len(new_words) + len(old_words) > 1000:
+                self._words = sorted(self._postings)
+            else:
+                for word in old_words:
+                    del self._words[bisect.bisect_left(self._words, word)]
+                for word in new_words:
+                    bisect.insort(self._words, word)
+            
+            self._roster = roster
+            self._positions = positions
+            self._repeats = {name: len(found) - 1 for name, found in positions.items() if len(found) > 1}
+            self.last_added = len(added)
+            self.last_removed = len(removed)
+        
+        logger.info(f"Индекс имен: +{len(added)} -{len(removed)} имен, {len(self._postings)} слов")
+        return self
+
+    def _match_word(self, word):
+        """Слова индекса, подходящие к слову запроса: {слово: оценка}"""
+        matches = {}
+        # Точное слово - 2, префикс - от 1 до 2 (чем больше совпало, тем выше)
+        i = bisect.bisect_left(self._words, word)
+        while i < len(self._words) and self._words[i].startswith(word):
+            candidate = self._words[i]
+            matches[candidate] = 1 + len(word) / len(candidate)
+            i += 1
+        
+        # Похожие слова: доля общих триграмм (коэффициент Жаккара) - до 1.
+        # Числа (табельные номера в ФИО) ищутся только точно и по префиксу
+        if len(word) >= 3 and not word.isdigit():
+            query = trigrams(word)
+            shared = Counter()
+            for trigram in query:
+                shared.update(self._trigrams.get(trigram, ()))
+            for candidate, common in shared.items():
+                if candidate in matches or common < FIND_SIMILARITY * len(query):
+                    continue
+                similarity = common / (len(query) + len(trigrams(candidate)) - common)
+                if similarity >= FIND_SIMILARITY:
+                    matches[candidate] = similarity
+        
+        return matches
+
+    def _name_scores(self, matches):
+        """Лучшая оценка слова для каждого имени: {имя: оценка}"""
+        scores = {}
+        # По возрастанию оценки: более подходящее слово перезаписывает менее подходящее
+        for word, score in sorted(matches.items(), key=lambda item: item[1]):
+            scores.update(dict.fromkeys(self._postings[word], score))
+        return scores
+
+    def search(self, query, limit=FIND_LIMIT):
+        """Люди, в ФИО которых есть все слова запроса: ([Person], всего найдено)"""
+        words = normalize_words(query)
+        if not words:
+            return [], 0
+        
+        with self._lock:
+            matches = [self._match_word(word) for word in words]
+            if not all(matches):
+                return [], 0
+            # Начинаем с самого редкого слова: дальше проверяются только его имена
+            matches.sort(key=lambda found: sum(len(self._postings[word]) for word in found))
+            
+            scores = self._name_scores(matches[0])
+            # Каждое слово запроса должно найтись в имени
+            for found in matches[1:]:
+                if not scores:
+                    break
+                best = self._name_scores(found)
+                scores = {name: score + best[name] for name, score in scores.items() if name in best}
+            
+            if not scores:
+                return [], 0
+            ranked = heapq.nsmallest(limit, ((-score, name) for name, score in scores.items()))
+            total = len(scores) + sum(self._repeats[name] for name in scores.keys() & self._repeats.keys())
+            people = [Person(self._roster, i) for _, name in ranked for i in self._positions[name]]
+            return people[:limit], total
+
+name_index = NameIndex()
+
+def build_name_index(roster):
+    with phase('name_index'):
+        return name_index.sync(roster)
+
+def get_name_index():
+    """Индекс имен (обновляется при загрузке нового ростера)"""
+    return roster_cache.derived('name_index', build_name_index)
+
+def current_age(person, today=None):
+    """Полных лет на сегодня"""
+    today = today or date.today()
+    return today.year - person.year - ((today.month, today.day) < (person.month, person.day))
+
+# ================== ФОРМАТИРОВАНИЕ ==================
+def format_age(age):
+    """Правильное склонение лет"""
+    if age % 10 == 1 and age % 100 != 11:
+        return f"{age} год"
+    elif 2 <= age % 10 <= 4 and (age % 100 < 10 or age % 100 >= 20):
+        return f"{age} года"
+    else:
+        return f"{age} лет"
+
+def format_birthday_list(birthdays, day_offset=0):
+    """Форматировать список дней рождения"""
+    if not birthdays:
+        return "нет"
+    
+    lines = []
+    for b in birthdays:
+        age_text = format_age(b.age)
+        lines.append(f"• {b.name} ({age_text})")
+    
+    return "\n".join(lines)
+
+# ================== КЭШ ОТВЕТОВ ==================
+class ResponseCache:
+    """LRU-кэш готовых ответов по ключу (команда, дата, версия ростера).
+
+    Текст команд зависит только от текущей даты и содержимого файла,
+    поэтому при смене даты (в полночь) или перезагрузке ростера кэш
+    целиком сбрасывается.
+    """
+
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._day = None
+        self._version = None
+        self.hits = 0
+        self.misses = 0
+
+    def _reset_if_stale(self, today, version):
+        if version != self._version:
+            self._entries.clear()
+        elif today != self._day:
+            # В других часовых поясах еще может быть вчера
+            yesterday = today - timedelta(days=1)
+            for key in [key for key in self._entries if key[1] < yesterday]:
+                del self._entries[key]
+        self._day = today
+        self._version = version
+
+    def get(self, command, render, day=None):
+        """Готовый ответ на команду; render() вызывается только при промахе.
+
+        day - дата, для которой строится ответ (по умолчанию сегодня).
+        """
+        get_roster()  # подхватить изменения файла до чтения версии
+        today = date.today()
+        version = roster_cache.version
+        key = (command, day or today, version)
+        
+        with self._lock:
+            self._reset_if_stale(today, version)
+            msg = self._entries.get(key)
+            if msg is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return msg
+            self.misses += 1
+        
+        msg = render()
+        
+        with self._lock:
+            # За время рендера могли наступить полночь или перезагрузка
+            if (today, version) == (date.today(), roster_cache.version):
+                self._reset_if_stale(today, version)
+                self._entries[key] = msg
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return msg
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+response_cache = ResponseCache()
+
+@metrics.collector
+def cache_metrics():
+    """Попадания/промахи кэшей ростера и ответов"""
+    roster = roster_cache.stats()
+    responses = response_cache.stats()
+    data, _, _ = roster_cache.snapshot()
+    return [
+        ('bot_cache_hits_total', 'counter', [({'cache': 'roster'}, roster['hits']),
+                                             ({'cache': 'response'}, responses['hits'])]),
+        ('bot_cache_misses_total', 'counter', [({'cache': 'roster'}, roster['misses']),
+                                               ({'cache': 'response'}, responses['misses'])]),
+        ('bot_cache_entries', 'gauge', [({'cache': 'response'}, responses['size'])]),
+        ('bot_roster_reloads_total', 'counter', [({}, roster['reloads'])]),
+        ('bot_roster_version', 'gauge', [({}, roster['version'])]),
+        ('bot_roster_people', 'gauge', [({}, len(data) if data is not None else 0)]),
+    ]
+
+def cached_renderer(command, render):
+    """Рендер команды через кэш ответов"""
+    return lambda message: response_cache.get(command, render)
+
+# ================== ОТДЕЛЫ ==================
+# Отдел в callback_data /all, а она не длиннее 64 байт
+DEPARTMENT_MAX_BYTES = 48
+
+def command_argument(message):
+    """Текст после команды: /find Иванов -> 'Иванов'"""
+    return (message.text or '').partition(' ')[2].strip()
+
+def command_department(message):
+    """Отдел из аргумента команды (обрезанный до DEPARTMENT_MAX_BYTES) или ''"""
+    department = command_argument(message)
+    return department.encode('utf-8')[:DEPARTMENT_MAX_BYTES].decode('utf-8', 'ignore').strip()
+
+def department_header(department):
+    """Строка с отделом над ответом (пустая без фильтра)"""
+    if not department:
+        return ""
+    return f"🏢 *Отдел:* {escape_markdown(department)}\n\n"
+
+def render_unknown_department(department):
+    """Ответ на отдел, которого нет среди источников"""
+    roster = get_roster()
+    msg = f"❌ Отдел «{escape_markdown(department)}» не найден"
+    if roster is not None:
+        msg += "\n\n*Источники:*\n"
+        msg += "\n".join(f"• {escape_markdown(source_label(source))}" for source in roster.sources)
+    return msg
+
+def department_key(command, department):
+    """Ключ кэша ответов для команды с отделом"""
+    return f"{command}:{department.casefold()}" if department else command
+
+def department_response(command, render, message, unknown=render_unknown_department):
+    """Ответ команды с необязательным отделом: /today Бухгалтерия.
+
+    Отдел выбирается по уже загруженному ростеру (имя файла или листа),
+    файлы для этого не перечитываются.
+    """
+    department = command_department(message)
+    if not department:
+        return response_cache.get(command, render)
+    if not department_sources(get_roster(), department):
+        return unknown(department)
+    return response_cache.get(department_key(command, department), lambda: render(department))
+
+def department_renderer(command, render):
+    """Рендер команды с отделом через кэш ответов"""
+    return lambda message: department_response(command, render, message)
+
+# ================== КОМАНДЫ БОТА ==================
+def render_welcome():
+    """Текст для /start и /help"""
+    # Загружаем данные для статистики
+    roster = get_roster()
+    
+    if roster is not None:
+        stats = f"📊 *Статистика из Excel:*\n"
+        stats += f"• Всего записей: {len(roster)}\n"
+        stats += f"• С указанной датой рождения: {roster.dated_count}\n"
+        stats += f"• Колонка ФИО: '{roster.fio_col}'\n"
+        stats += f"• Колонка дат: '{roster.date_col}'\n\n"
+    else:
+        stats = "⚠️ *Файл Excel не найден или не распознан*\n\n"
+    
+    welcome = f"""
+🎂 *Birthday Bot для Excel файла*
+
+{stats}
+*Команды:*
+/today - Дни рождения сегодня
+/tomorrow - Дни рождения завтра
+/after_tomorrow - Дни рождения послезавтра
+/week - Ближайшие 7 дней
+/all - Все дни рождения (только с датами)
+/count - Статистика по файлу
+/week Бухгалтерия - Только один отдел (файл или лист)
+/find - Поиск по ФИО, например: /find Иванов
+/export - Календарь для телефона (.ics), /export csv - таблица
+/subscribe - Получать ежедневный отчет в этот чат
+/unsubscribe - Отписаться от отчета
+/notify\\_time - Время и часовой пояс отчета
+/debug - Отладочная информация
+
+*Автоматически:* Ежедневно в 09:00 отправляется отчет.
+    """
+    
+    return welcome
+
+def render_today(department=None):
+    """Дни рождения сегодня"""
+    birthdays = get_today_birthdays(department=department)
+    today = datetime.now().strftime('%d.%m.%Y')
+    
+    if birthdays:
+        msg = f"🎂 *Сегодня ({today}) день рождения у:*\n\n"
+        msg += format_birthday_list(birthdays)
+    else:
+        msg = f"✅ Сегодня ({today}) дней рождения нет!"
+    
+    return department_header(department) + msg
+
+def render_tomorrow(department=None):
+    """Дни рождения завтра"""
+    birthdays = get_tomorrow_birthdays(department=department)
+    tomorrow = (datetime.now() + timedelta(days=1)).strftime('%d.%m.%Y')
+    
+    if birthdays:
+        msg = f"🎁 *Завтра ({tomorrow}) день рождения у:*\n\n"
+        msg += format_birthday_list(birthdays)
+    else:
+        msg = f"✅ Завтра ({tomorrow}) дней рождения нет!"
+    
+    return department_header(department) + msg
+
+def render_after_tomorrow(department=None):
+    """Дни рождения послезавтра"""
+    birthdays = get_after_tomorrow_birthdays(department=department)
+    after_tomorrow = (datetime.now() + timedelta(days=2)).strftime('%d.%m.%Y')
+    
+    if birthdays:
+        msg = f"📅 *Послезавтра ({after_tomorrow}) день рождения у:*\n\n"
+        msg += format_birthday_list(birthdays)
+    else:
+        msg = f"✅ Послезавтра ({after_tomorrow}) дней рождения нет!"
+    
+    return department_header(department) + msg
+
+def render_week(department=None):
+    """Ближайшие 7 дней"""
+    upcoming = get_upcoming_birthdays(7, department)
+    
+    if not upcoming:
+        msg = "✅ В ближайшие 7 дней дней рождения нет!"
+    else:
+        msg = "📅 *Ближайшие дни рождения (7 дней):*\n\n"
+        
+        # Группируем по дням
+        by_day = {}
+        for b in upcoming:
+            day = b.days_until
+            if day not in by_day:
+                by_day[day] = []
+            by_day[day].append(b)
+        
+        # Формируем сообщение по дням
+        for day in sorted(by_day.keys()):
+            date = datetime.now() + timedelta(days=day)
+            
+            if day == 0:
+                day_text = "🎂 СЕГОДНЯ"
+            elif day == 1:
+                day_text = "🎁 ЗАВТРА"
+            elif day == 2:
+                day_text = "📅 ПОСЛЕЗАВТРА"
+            else:
+                day_text = f"📅 {date.strftime('%d.%m')} (через {day} дней)"
+            
+            msg += f"{day_text}:\n"
+            
+            for b in by_day[day]:
+                age_text = format_age(b.age)
+                msg += f"  • {b.name} ({age_text})\n"
+            
+            msg += "\n"
+    
+    return department_header(department) + msg
+
+def all_pages(index):
+    """Страницы /all: список (месяц, страница в месяце, left, right)"""
+    pages = []
+    for month in range(1, 13):
+        left, right = index.month_range(month)
+        for page, page_left in enumerate(range(left, right, ALL_PAGE_SIZE)):
+            pages.append((month, page, page_left, min(page_left + ALL_PAGE_SIZE, right)))
+    return pages
+
+def month_name(month):
+    """Название месяца"""
+    return date(2000, month, 1).strftime('%B')
+
+def all_keyboard(pages, position, department=None):
+    """Кнопки навигации по страницам /all"""
+    markup = types.InlineKeyboardMarkup()
+    suffix = f":{department}" if department else ""
+    
+    navigation = []
+    if position > 0:
+        month, page = pages[position - 1][:2]
+        navigation.append(types.InlineKeyboardButton("◀️", callback_data=f"all:{month}:{page}{suffix}"))
+    navigation.append(types.InlineKeyboardButton(f"{position + 1}/{len(pages)}", callback_data="all:noop"))
+    if position < len(pages) - 1:
+        month, page = pages[position + 1][:2]
+        navigation.append(types.InlineKeyboardButton("▶️", callback_data=f"all:{month}:{page}{suffix}"))
+    markup.row(*navigation)
+    
+    # Быстрый переход к месяцу (только месяцы, где есть дни рождения)
+    months = sorted({month for month, _, _, _ in pages})
+    buttons = [types.InlineKeyboardButton(month_name(month)[:3], callback_data=f"all:{month}:0{suffix}")
+               for month in months]
+    for i in range(0, len(buttons), 6):
+        markup.row(*buttons[i:i + 6])
+    
+    return markup
+
+def render_all_page(month=None, page=0, department=None):
+    """Одна страница /all: (текст, клавиатура). По умолчанию - текущий месяц"""
+    # Индекс содержит только тех, у кого есть дата рождения, по порядку месяц/день
+    index = get_birthday_index(department)
+    pages = all_pages(index)
+    
+    if not pages:
+        return department_header(department) + "📭 В файле нет записей с датами рождения", None
+    
+    if month is None:
+        # Начинаем с текущего месяца или ближайшего следующего с днями рождения
+        current_month = datetime.now().month
+        position = next((i for i, p in enumerate(pages) if p[0] >= current_month and p[1] == 0), 0)
+    else:
+        # Если ростер поменялся и страницы больше нет - показываем начало месяца
+        position = next((i for i, p in enumerate(pages) if p[:2] == (month, page)), None)
+        if position is None:
+            position = next((i for i, p in enumerate(pages) if p[0] >= month), 0)
+    
+    month, page, left, right = pages[position]
+    month_pages = sum(1 for p in pages if p[0] == month)
+    
+    msg = department_header(department) + "📋 *Все дни рождения из файла:*\n\n"
+    msg += f"*{month_name(month).upper()}:*"
+    if month_pages > 1:
+        msg += f" (стр. {page + 1}/{month_pages})"
+    msg += "\n"
+    
+    current_year = datetime.now().year
+    lines = []
+    for person in index.sorted_people(left, right):
+        age_text = format_age(current_year - person.year)
+        lines.append(f"• {person.name} - {person.day:02d}.{month:02d} ({age_text})")
+    msg += "\n".join(lines) + "\n"
+    
+    return msg, all_keyboard(pages, position, department)
+
+def render_all():
+    """Первая страница /all (текст)"""
+    return render_all_page()[0]
+
+def render_all_department(department=None):
+    """Первая страница /all (по отделу, если указан): (текст, клавиатура)"""
+    return render_all_page(department=department)
+
+def unknown_department_page(department):
+    return render_unknown_department(department), None
+
+def parse_all_callback(data):
+    """Разобрать callback_data вида all:<месяц>:<страница>[:<отдел>]; None - ничего не делать"""
+    parts = data.split(':', 3)
+    if len(parts) not in (3, 4) or not parts[1].isdigit() or not parts[2].isdigit():
+        return None
+    month, page = int(parts[1]), int(parts[2])
+    if not 1 <= month <= 12:
+        return None
+    return month, page, parts[3] if len(parts) == 4 else None
+
+def all_page_response(month, page, department):
+    """Страница /all из callback (через кэш ответов)"""
+    return response_cache.get(department_key(f'all:{month}:{page}', department),
+                              lambda: render_all_page(month, page, department))
+
+def render_count(department=None):
+    """Статистика по файлу (или по источникам отдела)"""
+    roster = get_roster()
+    
+    if roster is None:
+        msg = "❌ Файл Excel не найден или поврежден"
+    else:
+        people = Counter(roster.source_ids)
+        if department:
+            selected = sorted(department_sources(roster, department))
+            dated = sum(1 for source, month in zip(roster.source_ids, roster.months)
+                        if month and source in selected)
+        else:
+            selected = range(len(roster.sources))
+            dated = roster.dated_count
+        sources = [roster.sources[i] for i in selected]
+        files = list(dict.fromkeys(source['file'] for source in sources if source['file']))
+        
+        msg = department_header(department) + f"📊 *Статистика файла:*\n\n"
+        if len(files) == 1:
+            msg += f"• Файл: `{files[0]}`\n"
+        else:
+            msg += f"• Файлов: {len(files)}, листов: {len(sources)}\n"
+        msg += f"• Всего строк: {sum(source['total_rows'] for source in sources)}\n"
+        msg += f"• Распознано людей: {sum(people[i] for i in selected)}\n"
+        msg += f"• С датой рождения: {dated}\n"
+        if roster.duplicates and not department:
+            msg += f"• Повторов в разных источниках: {roster.duplicates}\n"
+        
+        if len(sources) == 1 and sources[0]['fio_col'] and sources[0]['date_col']:
+            msg += f"• Колонка ФИО: `{sources[0]['fio_col']}`\n"
+            msg += f"• Колонка дат: `{sources[0]['date_col']}`\n"
+        elif len(sources) > 1:
+            msg += f"\n*Источники:*\n"
+            for i in selected:
+                msg += f"• {escape_markdown(source_label(roster.sources[i]))}: {people[i]}\n"
+        
+        # Самые близкие дни рождения
+        upcoming = get_upcoming_birthdays(30, department)[:5]  # Ближайшие 5 ДР в течение месяца
+        if upcoming:
+            msg += f"\n*Ближайшие дни рождения:*\n"
+            for b in upcoming:
+                date = datetime.now() + timedelta(days=b.days_until)
+                age_text = format_age(b.age)
+                msg += f"• {b.name} - {date.strftime('%d.%m')} ({age_text})\n"
+    
+    return msg
+
+def render_debug():
+    """Отладочная информация"""
+    roster = get_roster()
+    
+    if roster is None:
+        msg = "❌ Файл не найден"
+    else:
+        msg = f"🔍 *Отладочная информация:*\n\n"
+        for path in roster.files:
+            msg += f"• Файл: {path}\n"
+            if os.path.exists(path):
+                msg += f"• Размер: {os.path.getsize(path) / 1024:.1f} KB\n"
+        msg += f"• Лист: {roster.sheet or 'N/A'}\n"
+        if len(roster.sources) > 1:
+            msg += f"\n*Источники ({len(roster.sources)}):*\n"
+            for i, source in enumerate(roster.sources):
+                msg += f"{i+1}. {escape_markdown(source_label(source))}: "
+                msg += f"`{source['fio_col']}`, `{source['date_col']}`\n"
+        
+        if roster.columns:
+            msg += f"\n*Колонки листа:*\n"
+            for i, col in enumerate(roster.columns):
+                msg += f"{i+1}. `{col}`\n"
+        
+        if len(roster):
+            msg += f"\n*Первые 5 записей:*\n"
+            for i in range(min(5, len(roster))):
+                person = roster[i]
+                birthday_str = person.birthday.strftime('%d.%m.%Y') if person.birthday else 'НЕТ'
+                msg += f"{i+1}. {person.name} - {birthday_str}\n"
+    
+    cache = roster_cache.stats()
+    msg += f"\n*Кэш:* попаданий {cache['hits']}, промахов {cache['misses']}, "
+    msg += f"перезагрузок {cache['reloads']} (версия {cache['version']})\n"
+    responses = response_cache.stats()
+    msg += f"*Кэш ответов:* попаданий {responses['hits']}, промахов {responses['misses']}, "
+    msg += f"записей {responses['size']}\n"
+    queued = outbox.stats()
+    if queued:
+        msg += "*Очередь отчетов:* " + ", ".join(f"{state} {count}" for state, count in sorted(queued.items())) + "\n"
+    
+    return msg
+
+def render_find(message):
+    """Поиск людей по ФИО (допускает опечатки и начало слова)"""
+    query = command_argument(message)
+    if not query:
+        return "🔎 Укажите часть ФИО, например: /find Иванов"
+    
+    index = get_name_index()
+    with phase('query', metric=False):
+        people, total = index.search(query)
+    if not people:
+        return f"🔎 По запросу «{query}» никого не нашлось"
+    
+    msg = f"🔎 Найдено: {total}\n\n"
+    for person in people:
+        if person.month:
+            msg += f"• {person.name} - {person.day:02d}.{person.month:02d}.{person.year} ({format_age(current_age(person))})\n"
+        else:
+            msg += f"• {person.name} - дата рождения не указана\n"
+    if total > len(people):
+        msg += f"\n...и еще {total - len(people)}, уточните запрос"
+    return msg
+
+# Обработчики команд: polling-режим
+@bot.message_handler(commands=['start', 'help'])
+@timed('start')
+def send_welcome(message):
+    """Команда /start"""
+    bot.reply_to(message, response_cache.get('welcome', render_welcome), parse_mode='Markdown')
+
+@bot.message_handler(commands=['today'])
+@timed('today')
+def today_command(message):
+    """Дни рождения сегодня"""
+    bot.reply_to(message, department_response('today', render_today, message), parse_mode='Markdown')
+
+@bot.message_handler(commands=['tomorrow'])
+@timed('tomorrow')
+def tomorrow_command(message):
+    """Дни рождения завтра"""
+    bot.reply_to(message, department_response('tomorrow', render_tomorrow, message), parse_mode='Markdown')
+
+@bot.message_handler(commands=['after_tomorrow', 'послезавтра'])
+@timed('after_tomorrow')
+def after_tomorrow_command(message):
+    """Дни рождения послезавтра"""
+    bot.reply_to(message, department_response('after_tomorrow', render_after_tomorrow, message), parse_mode='Markdown')
+
+@bot.message_handler(commands=['week'])
+@timed('week')
+def week_command(message):
+    """Ближайшие 7 дней"""
+    bot.reply_to(message, department_response('week', render_week, message), parse_mode='Markdown')
+
+@bot.message_handler(commands=['all'])
+@timed('all')
+def all_command(message):
+    """Все дни рождения из файла (по страницам)"""
+    msg, markup = department_response('all', render_all_department, message, unknown=unknown_department_page)
+    bot.reply_to(message, msg, parse_mode='Markdown', reply_markup=markup)
+
+@bot.callback_query_handler(func=lambda call: call.data and call.data.startswith('all:'))
+@timed('all_page')
+def all_page_callback(call):
+    """Переход по страницам /all"""
+    target = parse_all_callback(call.data)
+    if target is not None:
+        msg, markup = all_page_response(*target)
+        try:
+            bot.edit_message_text(msg, call.message.chat.id, call.message.message_id,
+                                  parse_mode='Markdown', reply_markup=markup)
+        except telebot.apihelper.ApiTelegramException as e:
+            # Нажата кнопка текущей страницы - текст не изменился
+            if 'message is not modified' not in str(e):
+                raise
+    bot.answer_callback_query(call.id)
+
+@bot.message_handler(commands=['count'])
+@timed('count')
+def count_command(message):
+    """Статистика по файлу"""
+    bot.reply_to(message, department_response('count', render_count, message), parse_mode='Markdown')
+
+@bot.message_handler(commands=['find'])
+@timed('find')
+def find_command(message):
+    """Поиск по ФИО"""
+    bot.reply_to(message, render_find(message))
+
+@bot.message_handler(commands=['debug'])
+@timed('debug')
+def debug_command(message):
+    """Отладочная информация"""
+    bot.reply_to(message, render_debug(), parse_mode='Markdown')
+
+# ================== ВЫГРУЗКА КАЛЕНДАРЯ ==================
+# Записи берутся из уже разобранного ростера (ФИО и даты нормализованы
+# при загрузке) по одной и сразу пишутся во временный файл
+EXPORT_FORMATS = ('ics', 'csv')
+ICS_LINE_LIMIT = 75  # октетов в строке iCalendar (RFC 5545), дальше - перенос
+
+def export_people(roster, sources=None):
+    """Записи ростера по одной (только из источников sources, если заданы)"""
+    for i in range(len(roster)):
+        if sources is None or roster.source_ids[i] in sources:
+            yield roster[i]
+
+def ics_escape(text):
+    """Экранирование текста в iCalendar"""
+    return (text.replace('\\', '\\\\').replace(';', '\\;')
+            .replace(',', '\\,').replace('\n', '\\n'))
+
+def ics_line(line):
+    """Строка iCalendar с переносом по 75 октетов (не разрывая символы UTF-8)"""
+    data = line.encode('utf-8')
+    if len(data) <= ICS_LINE_LIMIT:
+        return line + '\r\n'
+    parts = []
+    limit = ICS_LINE_LIMIT
+    while data:
+        cut = min(limit, len(data))
+        while cut < len(data) and (data[cut] & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(data[:cut].decode('utf-8'))
+        data = data[cut:]
+        limit = ICS_LINE_LIMIT - 1  # продолжение начинается с пробела
+    return '\r\n '.join(parts) + '\r\n'
+
+def iter_ics(roster, sources=None):
+    """Календарь iCalendar: ежегодное событие на каждый день рождения"""
+    stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    yield ics_line('BEGIN:VCALENDAR')
+    yield ics_line('VERSION:2.0')
+    yield ics_line('PRODID:-//Birthday Bot//RU')
+    yield ics_line('CALSCALE:GREGORIAN')
+    yield ics_line('X-WR-CALNAME:Дни рождения')
+    
+    for person in export_people(roster, sources):
+        if not person.month:
+            continue
+        # UID не зависит от порядка строк: повторный импорт обновит события, а не продублирует
+        uid = hashlib.sha1(f"{person.name}|{person.birthday:%Y%m%d}".encode('utf-8')).hexdigest()
+        if person.month == 2 and person.day == 29:
+            # В невисокосный год - 28 февраля, как в ежедневном отчете
+            rule = 'RRULE:FREQ=YEARLY;BYMONTH=2;BYMONTHDAY=-1'
+        else:
+            rule = 'RRULE:FREQ=YEARLY'
+        yield ''.join((
+            ics_line('BEGIN:VEVENT'),
+            ics_line(f"UID:{uid}@birthday-bot"),
+            ics_line(f"DTSTAMP:{stamp}"),
+            ics_line(f"DTSTART;VALUE=DATE:{person.birthday:%Y%m%d}"),
+            ics_line(rule),
+            ics_line(f"SUMMARY:{ics_escape('🎂 ' + person.name)}"),
+            ics_line(f"DESCRIPTION:{ics_escape(f'Дата рождения: {person.birthday:%d.%m.%Y}')}"),
+            ics_line(f"CATEGORIES:{ics_escape(source_label(person.source))}"),
+            ics_line('TRANSP:TRANSPARENT'),
+            ics_line('END:VEVENT'),
+        ))
+    
+    yield ics_line('END:VCALENDAR')
+
+def iter_csv(roster, sources=None):
+    """Таблица CSV (разделитель ';' и BOM - так ее открывает Excel с русской локалью)"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=';', lineterminator='\r\n')
+    writer.writerow(['ФИО', 'Дата рождения', 'День рождения', 'Файл', 'Лист'])
+    yield '\ufeff' + buffer.getvalue()
+    
+    for person in export_people(roster, sources):
+        buffer.seek(0)
+        buffer.truncate()
+        birthday = person.birthday
+        source = person.source
+        writer.writerow([
+            person.name,
+            birthday.strftime('%d.%m.%Y') if birthday else '',
+            birthday.strftime('%d.%m') if birthday else '',
+            os.path.basename(source['file']) if source['file'] else '',
+            source['sheet'] or '',
+        ])
+        yield buffer.getvalue()
+
+EXPORTERS = {'ics': iter_ics, 'csv': iter_csv}
+
+def write_export(chunks, fmt):
+    """Записать выгрузку во временный файл по частям; путь к файлу"""
+    fd, path = tempfile.mkstemp(prefix='birthdays-', suffix=f'.{fmt}')
+    try:
+        with open(fd, 'w', encoding='utf-8', newline='') as f:
+            for chunk in chunks:
+                f.write(chunk)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
+
+def parse_export_args(message):
+    """/export [ics|csv] [отдел] -> (формат, отдел)"""
+    argument = command_argument(message)
+    fmt, _, rest = argument.partition(' ')
+    if fmt.lower() in EXPORT_FORMATS:
+        return fmt.lower(), rest.strip()
+    return EXPORT_FORMATS[0], argument
+
+def build_export(message):
+    """Выгрузка по команде во временный файл: (путь, имя файла) или текст ошибки"""
+    fmt, department = parse_export_args(message)
+    roster = get_roster()
+    if roster is None:
+        return "❌ Файл Excel не найден или поврежден"
+    
+    sources = None
+    if department:
+        sources = department_sources(roster, department)
+        if not sources:
+            return render_unknown_department(department)
+    
+    with phase('export', metric=False):
+        path = write_export(EXPORTERS[fmt](roster, sources), fmt)
+    logger.info(f"Выгрузка {fmt} для чата {message.chat.id}: {os.path.getsize(path) / 1024:.1f} KB")
+    return path, f"birthdays-{date.today():%Y%m%d}.{fmt}"
+
+# Выгрузка идет в своих потоках: обработчики команд ее не ждут
+export_executor = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix='export')
+
+def send_export(message):
+    """Собрать и отправить файл выгрузки (в потоке export_executor)"""
+    try:
+        result = build_export(message)
+        if isinstance(result, str):
+            bot.reply_to(message, result, parse_mode='Markdown')
+            return
+        
+        path, filename = result
+        try:
+            with open(path, 'rb') as f:
+                bot.send_document(message.chat.id, f, reply_to_message_id=message.message_id,
+                                  visible_file_name=filename)
+        finally:
+            os.remove(path)
+    except Exception as e:
+        logger.error(f"Ошибка выгрузки: {e}")
+
+@bot.message_handler(commands=['export'])
+@timed('export')
+def export_command(message):
+    """Календарь дней рождения файлом (.ics или .csv)"""
+    export_executor.submit(send_export, message)
+
+# ================== ПРОФИЛИРОВАНИЕ ==================
+# Фазы верхнего уровня в отчете /profile; остальные (read, parse, query...) вложены в них
+PROFILE_PHASES = ('roster', 'render', 'send')
+
+def is_admin(message):
+    """Сообщение из чата админа"""
+    return bool(ADMIN_CHAT_ID) and str(message.chat.id) == str(ADMIN_CHAT_ID)
+
+def department_target(render):
+    return lambda message: render(command_department(message) or None)
+
+def profile_reload(message):
+    """Разобрать файлы заново (ростер в кэше не подменяется)"""
+    roster = load_sources(resolve_sources())
+    return f"🔄 Файлы разобраны заново: {len(roster) if roster is not None else 0} записей"
+
+def profile_export(message):
+    """Выгрузка без отправки файла"""
+    result = build_export(message)
+    if isinstance(result, str):
+        return result
+    path, filename = result
+    size = os.path.getsize(path)
+    os.remove(path)
+    return f"📎 {filename}: {size / 1024:.1f} KB"
+
+# Команды для /profile: {команда: (функция(message) -> текст, ответ в Markdown)}.
+# Ответ строится заново, мимо кэша ответов
+PROFILE_TARGETS = {
+    'start': (lambda message: render_welcome(), True),
+    'today': (department_target(render_today), True),
+    'tomorrow': (department_target(render_tomorrow), True),
+    'after_tomorrow': (department_target(render_after_tomorrow), True),
+    'week': (department_target(render_week), True),
+    'all': (lambda message: render_all_department(command_department(message) or None)[0], True),
+    'count': (department_target(render_count), True),
+    'find': (render_find, False),
+    'debug': (lambda message: render_debug(), True),
+    'export': (profile_export, True),
+    'reload': (profile_reload, False),
+}
+
+_profile_lock = threading.Lock()
+
+def format_profile_report(command, total, phases, profiler, path):
+    """Отчет /profile: фазы и самые долгие функции по собственному времени"""
+    lines = [f"Фазы, мс (всего {total * 1000:.1f}):"]
+    for name in PROFILE_PHASES:
+        lines.append(f"  {name:<16}{phases.get(name, 0.0) * 1000:>9.1f}")
+    nested = [(name, seconds) for name, seconds in phases.items() if name not in PROFILE_PHASES]
+    if nested:
+        lines.append("В том числе:")
+        for name, seconds in sorted(nested, key=lambda item: -item[1]):
+            lines.append(f"  {name:<16}{seconds * 1000:>9.1f}")
+    
+    stats = pstats.Stats(profiler)
+    stats.sort_stats(pstats.SortKey.TIME)
+    lines.append("")
+    lines.append("   своё, мс  всего, мс  вызовов  функция")
+    for func in stats.fcn_list[:PROFILE_TOP]:
+        _, calls, own, cumulative, _ = stats.stats[func]
+        filename, line, name = func
+        where = f"{os.path.basename(filename)}:{line}({name})" if line else name
+        lines.append(f"{own * 1000:>11.1f}{cumulative * 1000:>11.1f}{calls:>9}  {where[:60]}")
+    
+    msg = f"⏱ *Профиль /{command}*\n```\n" + "\n".join(lines) + "\n```\n"
+    msg += f"Полный профиль: `{path}`"
+    return msg
+
+def run_profile(message, send):
+    """Выполнить команду из /profile <команда> под cProfile.
+
+    send(текст, markdown) отправляет ответ команды - это фаза send.
+    Возвращает текст отчета; профиль сохраняется в PROFILE_DIR.
+    """
+    command, _, rest = command_argument(message).lstrip('/').partition(' ')
+    command = command.split('@')[0].lower()
+    if command == 'help':
+        command = 'start'
+    if command not in PROFILE_TARGETS:
+        return "⏱ Укажите команду: " + escape_markdown(", ".join(f"/profile {name}" for name in PROFILE_TARGETS))
+    target, markdown = PROFILE_TARGETS[command]
+    
+    # Команда получает такое же сообщение, как если бы ее отправили напрямую
+    target_message = copy.copy(message)
+    target_message.text = f"/{command} {rest}".strip()
+    
+    profiler = cProfile.Profile()
+    started = time.perf_counter()
+    with trace_phases() as phases:
+        profiler.enable()
+        try:
+            with phase('roster', metric=False):
+                get_roster()
+            with phase('render', metric=False):
+                text = target(target_message)
+            with phase('send', metric=False):
+                send(text, markdown)
+        finally:
+            profiler.disable()
+    total = time.perf_counter() - started
+    
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"{command}-{datetime.now():%Y%m%d-%H%M%S-%f}.prof")
+    profiler.dump_stats(path)
+    logger.info(f"Профиль /{command}: {total * 1000:.1f} мс, записан в {path}")
+    return format_profile_report(command, total, phases, profiler, path)
+
+def render_profile(message, send):
+    """Ответ на /profile: профилирование идет по одному за раз"""
+    if not _profile_lock.acquire(blocking=False):
+        return "⏱ Уже идет профилирование другой команды, попробуйте позже"
+    try:
+        return run_profile(message, send)
+    except Exception as e:
+        logger.error(f"Ошибка профилирования: {e}")
+        return f"❌ Ошибка профилирования: {escape_markdown(str(e))}"
+    finally:
+        _profile_lock.release()
+
+@bot.message_handler(commands=['profile'])
+@timed('profile')
+def profile_command(message):
+    """Профиль команды: время по фазам и горячие точки (только для админа)"""
+    if not is_admin(message):
+        bot.reply_to(message, "⛔ Команда доступна только администратору")
+        return
+    
+    def send(text, markdown):
+        bot.reply_to(message, text, parse_mode='Markdown' if markdown else None)
+    
+    bot.reply_to(message, render_profile(message, send), parse_mode='Markdown')
+
+# ================== ПОДПИСЧИКИ И РАССЫЛКА ==================
+class SubscriberRegistry:
+    """Чаты, подписанные на ежедневный отчет (хранятся в JSON файле)"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._chats = {}
+        try:
+            with open(path, encoding='utf-8') as f:
+                self._chats = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.error(f"Не удалось прочитать {path}: {e}")
+
+    def _save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._chats, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def add(self, chat_id):
+        """Подписать чат; False если он уже подписан"""
+        with self._lock:
+            key = str(chat_id)
+            if key in self._chats:
+                return False
+            self._chats[key] = {
+                'subscribed_at': datetime.now().isoformat(timespec='seconds'),
+                'time': NOTIFICATION_TIME,
+                'tz': NOTIFICATION_TZ,
+            }
+            self._save()
+            return True
+
+    def update(self, chat_id, **settings):
+        """Изменить настройки подписанного чата (time, tz)"""
+        with self._lock:
+            self._chats[str(chat_id)].update(settings)
+            self._save()
+
+    def settings(self, chat_id):
+        """Время и часовой пояс доставки: (HH:MM, пояс)"""
+        with self._lock:
+            chat = self._chats.get(str(chat_id), {})
+            return chat.get('time', NOTIFICATION_TIME), chat.get('tz', NOTIFICATION_TZ)
+
+    def remove(self, chat_id):
+        """Отписать чат; False если он не был подписан"""
+        with self._lock:
+            if self._chats.pop(str(chat_id), None) is None:
+                return False
+            self._save()
+            return True
+
+    def chat_ids(self):
+        with self._lock:
+            return list(self._chats)
+
+    def __contains__(self, chat_id):
+        with self._lock:
+            return str(chat_id) in self._chats
+
+    def __len__(self):
+        with self._lock:
+            return len(self._chats)
+
+subscribers = SubscriberRegistry(SUBSCRIBERS_FILE)
+
+class RateLimiter:
+    """Token bucket: не больше rate событий в секунду"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Дождаться разрешения на одно событие"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                else:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Остановить выдачу на seconds секунд (ответ 429 от Telegram)"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+class Broadcaster:
+    """Рассылка сообщений во много чатов через пул потоков.
+
+    Соблюдает общий лимит Telegram (BROADCAST_RATE сообщений в секунду)
+    и интервал между сообщениями в один чат. На 429 ждет retry_after и
+    приостанавливает всю рассылку, на ошибки сети и 5xx повторяет с
+    экспоненциальной задержкой, на прочие ошибки (бот заблокирован и
+    т.п.) не повторяет.
+    """
+
+    def __init__(self, telegram_bot, workers=BROADCAST_WORKERS, rate=BROADCAST_RATE,
+                 chat_interval=BROADCAST_CHAT_INTERVAL, retries=BROADCAST_RETRIES):
+        self._bot = telegram_bot
+        self.workers = workers
+        self.retries = retries
+        self.chat_interval = chat_interval
+        self._limiter = RateLimiter(rate)
+        self._chat_lock = threading.Lock()
+        self._chat_next = {}
+
+    def _wait_for_chat(self, chat_id):
+        with self._chat_lock:
+            now = time.monotonic()
+            slot = max(now, self._chat_next.get(chat_id, 0.0))
+            self._chat_next[chat_id] = slot + self.chat_interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def _deliver(self, chat_id, text, parse_mode, on_start=None):
+        """Отправить одно сообщение: (число повторов, ошибка или None)
+
+        on_start(chat_id) вызывается один раз перед первой попыткой отправки.
+        """
+        retries = 0
+        while True:
+            self._limiter.acquire()
+            self._wait_for_chat(chat_id)
+            if on_start is not None:
+                on_start(chat_id)
+                on_start = None
+            try:
+                self._bot.send_message(chat_id, text, parse_mode=parse_mode)
+                return retries, None
+            except telebot.apihelper.ApiTelegramException as e:
+                error = e
+                if e.error_code == 429:
+                    retry_after = (e.result_json.get('parameters') or {}).get('retry_after', 1)
+                    logger.warning(f"Telegram просит подождать {retry_after} с (чат {chat_id})")
+                    self._limiter.pause(retry_after)
+                    delay = 0
+                elif e.error_code >= 500:
+                    delay = 2 ** retries
+                else:
+                    return retries, error
+            except Exception as e:
+                # Ошибки сети
+                error = e
+                delay = 2 ** retries
+            
+            if retries >= self.retries:
+                return retries, error
+            retries += 1
+            if delay:
+                time.sleep(delay)
+
+    def broadcast(self, messages, parse_mode='Markdown', on_start=None):
+        """Разослать [(chat_id, text), ...]; вернуть отчет о доставке"""
+        started = time.perf_counter()
+        report = {'sent': 0, 'failed': 0, 'retries': 0, 'errors': {}}
+        if not messages:
+            report['elapsed'] = 0.0
+            report['rate'] = 0.0
+            return report
+        
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='broadcast') as pool:
+            futures = {pool.submit(self._deliver, chat_id, text, parse_mode, on_start): chat_id
+                       for chat_id, text in messages}
+            for future, chat_id in futures.items():
+                retries, error = future.result()
+                report['retries'] += retries
+                if error is None:
+                    report['sent'] += 1
+                else:
+                    report['failed'] += 1
+                    report['errors'][chat_id] = str(error)
+        
+        report['elapsed'] = time.perf_counter() - started
+        report['rate'] = report['sent'] / report['elapsed'] if report['elapsed'] else 0.0
+        logger.info(
+            f"Рассылка: отправлено {report['sent']}, ошибок {report['failed']}, "
+            f"повторов {report['retries']} за {report['elapsed']:.1f} с ({report['rate']:.1f} сообщ./с)"
+        )
+        for chat_id, error in list(report['errors'].items())[:10]:
+            logger.warning(f"Не доставлено в {chat_id}: {error}")
+        return report
 
-def format_birthday_list(birthdays, day_offset=0):
-    """Форматировать список дней рождения"""
-    if not birthdays:
-        return "нет"
+broadcaster = Broadcaster(bot)
+
+def render_subscribe(message):
+    """Подписать чат на ежедневный отчет"""
+    if subscribers.add(message.chat.id):
+        delivery_time, tz_name = subscribers.settings(message.chat.id)
+        scheduler.schedule(str(message.chat.id), delivery_time, tz_name)
+        return (f"🔔 Чат подписан на ежедневный отчет ({delivery_time} {tz_name})\n"
+                f"Изменить время: /notify_time ЧЧ:ММ [Часовой/Пояс]")
+    return "ℹ️ Чат уже подписан на ежедневный отчет"
+
+def render_unsubscribe(message):
+    """Отписать чат от ежедневного отчета"""
+    if subscribers.remove(message.chat.id):
+        scheduler.unschedule(str(message.chat.id))
+        return "🔕 Чат отписан от ежедневного отчета"
+    return "ℹ️ Чат не был подписан"
+
+def render_notify_time(message):
+    """Время и часовой пояс ежедневного отчета для чата"""
+    chat_id = str(message.chat.id)
+    args = (message.text or '').split()[1:]
     
-    lines = []
-    for b in birthdays:
-        age_text = format_age(b['age'])
-        lines.append(f"• {b['name']} ({age_text})")
+    if chat_id not in subscribers:
+        return "ℹ️ Чат не подписан. Подписаться: /subscribe"
     
-    return "\n".join(lines)
-
-# ================== КОМАНДЫ БОТА ==================
-@bot.message_handler(commands=['start', 'help'])
-def send_welcome(message):
-    """Команда /start"""
-    # Загружаем данные для статистики
-    people, df, fio_col, date_col = load_excel_data()
+    if not args:
+        delivery_time, tz_name = subscribers.settings(chat_id)
+        return f"⏰ Отчет приходит в {delivery_time} ({tz_name})"
     
-    if df is not None:
-        total_people = len(people)
-        people_with_dates = len([p for p in people if p['birthday']])
-        
-        stats = f"📊 *Статистика из Excel:*\n"
-        stats += f"• Всего записей: {total_people}\n"
-        stats += f"• С указанной датой рождения: {people_with_dates}\n"
-        stats += f"• Колонка ФИО: '{fio_col}'\n"
-        stats += f"• Колонка дат: '{date_col}'\n\n"
-    else:
-        stats = "⚠️ *Файл Excel не найден или не распознан*\n\n"
+    try:
+        delivery_time = parse_delivery_time(args[0])
+    except ValueError:
+        return "❌ Время в формате ЧЧ:ММ, например: /notify_time 09:30 Europe/Moscow"
     
-    welcome = f"""
-🎂 *Birthday Bot для Excel файла*
+    tz_name = args[1] if len(args) > 1 else subscribers.settings(chat_id)[1]
+    if load_timezone(tz_name) is None:
+        return f"❌ Неизвестный часовой пояс: {tz_name}"
+    
+    subscribers.update(chat_id, time=delivery_time, tz=tz_name)
+    scheduler.schedule(chat_id, delivery_time, tz_name)
+    return f"⏰ Отчет будет приходить в {delivery_time} ({tz_name})"
 
-{stats}
-*Команды:*
-/today - Дни рождения сегодня
-/tomorrow - Дни рождения завтра
-/after_tomorrow - Дни рождения послезавтра
-/week - Ближайшие 7 дней
-/all - Все дни рождения (только с датами)
-/count - Статистика по файлу
-/debug - Отладочная информация
+# Команды, ответ на которые зависит от сообщения (не кэшируются)
+MESSAGE_COMMANDS = [
+    (['find'], render_find),
+    (['subscribe'], render_subscribe),
+    (['unsubscribe'], render_unsubscribe),
+    (['notify_time'], render_notify_time),
+]
 
-*Автоматически:* Ежедневно в 09:00 отправляется отчет.
+@bot.message_handler(commands=['subscribe'])
+@timed('subscribe')
+def subscribe_command(message):
+    """Подписаться на ежедневный отчет"""
+    bot.reply_to(message, render_subscribe(message))
+
+@bot.message_handler(commands=['unsubscribe'])
+@timed('unsubscribe')
+def unsubscribe_command(message):
+    """Отписаться от ежедневного отчета"""
+    bot.reply_to(message, render_unsubscribe(message))
+
+@bot.message_handler(commands=['notify_time'])
+@timed('notify_time')
+def notify_time_command(message):
+    """Время и часовой пояс ежедневного отчета"""
+    bot.reply_to(message, render_notify_time(message))
+
+# ================== АСИНХРОННЫЙ РЕЖИМ ==================
+# Команды и функции, которые формируют ответ (общие для обоих режимов)
+COMMAND_RENDERERS = [
+    (['start', 'help'], cached_renderer('welcome', render_welcome)),
+    (['today'], department_renderer('today', render_today)),
+    (['tomorrow'], department_renderer('tomorrow', render_tomorrow)),
+    (['after_tomorrow', 'послезавтра'], department_renderer('after_tomorrow', render_after_tomorrow)),
+    (['week'], department_renderer('week', render_week)),
+    (['count'], department_renderer('count', render_count)),
+    (['debug'], lambda message: render_debug()),
+]
+
+def warm_roster():
+    """Загрузить ростер и построить индексы (выполняется в пуле потоков)"""
+    roster = get_roster()
+    get_birthday_index()
+    get_name_index()
+    return roster
+
+class AsyncRosterLoader:
+    """Загрузка ростера вне event loop.
+
+    Загрузка выполняется в пуле потоков; если она уже идет, новые
+    запросы ждут ту же самую задачу, а не запускают свою.
     """
-    
-    bot.reply_to(message, welcome, parse_mode='Markdown')
 
-@bot.message_handler(commands=['today'])
-def today_command(message):
-    """Дни рождения сегодня"""
-    birthdays = get_today_birthdays()
-    today = datetime.now().strftime('%d.%m.%Y')
+    def __init__(self, executor):
+        self._executor = executor
+        self._inflight = None
+
+    async def get(self):
+        """Дождаться актуального ростера"""
+        import asyncio
+        
+        if self._inflight is None:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self._executor, warm_roster)
+            self._inflight = future
+            future.add_done_callback(self._finished)
+        # shield: отмена одного обработчика не отменяет общую загрузку
+        return await asyncio.shield(self._inflight)
+
+    def _finished(self, future):
+        if self._inflight is future:
+            self._inflight = None
+
+def create_async_bot(executor):
+    """AsyncTeleBot с теми же командами, что и у синхронного бота"""
+    # asyncio импортируется только в async-режиме: polling и вебхук без него стартуют быстрее
+    import asyncio
+    from telebot.async_telebot import AsyncTeleBot
     
-    if birthdays:
-        msg = f"🎂 *Сегодня ({today}) день рождения у:*\n\n"
-        msg += format_birthday_list(birthdays)
-    else:
-        msg = f"✅ Сегодня ({today}) дней рождения нет!"
+    if TELEGRAM_API_URL:
+        telebot.asyncio_helper.API_URL = TELEGRAM_API_URL
+    if metrics.enabled:
+        instrument_async_telegram_api()
+    async_bot = AsyncTeleBot(BOT_TOKEN)
+    loader = AsyncRosterLoader(executor)
     
-    bot.reply_to(message, msg, parse_mode='Markdown')
-
-@bot.message_handler(commands=['tomorrow'])
-def tomorrow_command(message):
-    """Дни рождения завтра"""
-    birthdays = get_tomorrow_birthdays()
-    tomorrow = (datetime.now() + timedelta(days=1)).strftime('%d.%m.%Y')
+    def make_handler(command, render):
+        @timed(command)
+        async def handler(message):
+            await loader.get()
+            msg = await asyncio.get_running_loop().run_in_executor(executor, render, message)
+            await async_bot.reply_to(message, msg, parse_mode='Markdown')
+        return handler
     
-    if birthdays:
-        msg = f"🎁 *Завтра ({tomorrow}) день рождения у:*\n\n"
-        msg += format_birthday_list(birthdays)
-    else:
-        msg = f"✅ Завтра ({tomorrow}) дней рождения нет!"
+    for commands, render in COMMAND_RENDERERS:
+        async_bot.register_message_handler(make_handler(commands[0], render), commands=commands)
     
-    bot.reply_to(message, msg, parse_mode='Markdown')
-
-@bot.message_handler(commands=['after_tomorrow', 'послезавтра'])
-def after_tomorrow_command(message):
-    """Дни рождения послезавтра"""
-    birthdays = get_after_tomorrow_birthdays()
-    after_tomorrow = (datetime.now() + timedelta(days=2)).strftime('%d.%m.%Y')
+    def make_message_handler(command, render):
+        @timed(command)
+        async def handler(message):
+            msg = await asyncio.get_running_loop().run_in_executor(executor, render, message)
+            await async_bot.reply_to(message, msg)
+        return handler
     
-    if birthdays:
-        msg = f"📅 *Послезавтра ({after_tomorrow}) день рождения у:*\n\n"
-        msg += format_birthday_list(birthdays)
-    else:
-        msg = f"✅ Послезавтра ({after_tomorrow}) дней рождения нет!"
+    for commands, render in MESSAGE_COMMANDS:
+        async_bot.register_message_handler(make_message_handler(commands[0], render), commands=commands)
     
-    bot.reply_to(message, msg, parse_mode='Markdown')
-
-@bot.message_handler(commands=['week'])
-def week_command(message):
-    """Ближайшие 7 дней"""
-    upcoming = get_upcoming_birthdays(7)
+    @timed('all')
+    async def all_handler(message):
+        await loader.get()
+        msg, markup = await asyncio.get_running_loop().run_in_executor(
+            executor, functools.partial(department_response, 'all', render_all_department, message,
+                                        unknown=unknown_department_page))
+        await async_bot.reply_to(message, msg, parse_mode='Markdown', reply_markup=markup)
     
-    if not upcoming:
-        msg = "✅ В ближайшие 7 дней дней рождения нет!"
-    else:
-        msg = "📅 *Ближайшие дни рождения (7 дней):*\n\n"
+    @timed('all_page')
+    async def all_page_handler(call):
+        target = parse_all_callback(call.data)
+        if target is not None:
+            await loader.get()
+            msg, markup = await asyncio.get_running_loop().run_in_executor(
+                executor, all_page_response, *target)
+            try:
+                await async_bot.edit_message_text(msg, call.message.chat.id, call.message.message_id,
+                                                  parse_mode='Markdown', reply_markup=markup)
+            except telebot.asyncio_helper.ApiTelegramException as e:
+                if 'message is not modified' not in str(e):
+                    raise
+        await async_bot.answer_callback_query(call.id)
+    
+    @timed('export')
+    async def export_handler(message):
+        await loader.get()
+        result = await asyncio.get_running_loop().run_in_executor(export_executor, build_export, message)
+        if isinstance(result, str):
+            await async_bot.reply_to(message, result, parse_mode='Markdown')
+            return
+        path, filename = result
+        try:
+            with open(path, 'rb') as f:
+                await async_bot.send_document(message.chat.id, f, reply_to_message_id=message.message_id,
+                                              visible_file_name=filename)
+        finally:
+            os.remove(path)
+    
+    @timed('profile')
+    async def profile_handler(message):
+        if not is_admin(message):
+            await async_bot.reply_to(message, "⛔ Команда доступна только администратору")
+            return
         
-        # Группируем по дням
-        by_day = {}
-        for b in upcoming:
-            day = b['days_until']
-            if day not in by_day:
-                by_day[day] = []
-            by_day[day].append(b)
+        loop = asyncio.get_running_loop()
         
-        # Формируем сообщение по дням
-        for day in sorted(by_day.keys()):
-            date = datetime.now() + timedelta(days=day)
-            
-            if day == 0:
-                day_text = "🎂 СЕГОДНЯ"
-            elif day == 1:
-                day_text = "🎁 ЗАВТРА"
-            elif day == 2:
-                day_text = "📅 ПОСЛЕЗАВТРА"
-            else:
-                day_text = f"📅 {date.strftime('%d.%m')} (через {day} дней)"
-            
-            msg += f"{day_text}:\n"
-            
-            for b in by_day[day]:
-                age_text = format_age(b['age'])
-                msg += f"  • {b['name']} ({age_text})\n"
-            
-            msg += "\n"
-    
-    bot.reply_to(message, msg, parse_mode='Markdown')
-
-@bot.message_handler(commands=['all'])
-def all_command(message):
-    """Все дни рождения из файла"""
-    people, _, _, _ = load_excel_data()
+        def send(text, markdown):
+            # Профиль снимается в потоке пула, отправка - в event loop
+            reply = async_bot.reply_to(message, text, parse_mode='Markdown' if markdown else None)
+            asyncio.run_coroutine_threadsafe(reply, loop).result()
+        
+        await loader.get()
+        msg = await loop.run_in_executor(executor, render_profile, message, send)
+        await async_bot.reply_to(message, msg, parse_mode='Markdown')
     
-    # Фильтруем только тех, у кого есть дата рождения
-    people_with_birthdays = [p for p in people if p['birthday']]
+    async_bot.register_message_handler(all_handler, commands=['all'])
+    async_bot.register_message_handler(profile_handler, commands=['profile'])
+    async_bot.register_message_handler(export_handler, commands=['export'])
+    async_bot.register_callback_query_handler(
+        all_page_handler, func=lambda call: call.data and call.data.startswith('all:'))
     
-    if not people_with_birthdays:
-        msg = "📭 В файле нет записей с датами рождения"
-    else:
-        # Сортируем по дате рождения (игнорируя год)
-        people_with_birthdays.sort(key=lambda x: (x['birthday'].month, x['birthday'].day))
+    return async_bot, loader
+
+async def run_async_bot(init_started=None):
+    """Запуск бота в асинхронном режиме
+
+    init_started - начало фазы bot_init: она заканчивается только после
+    создания AsyncTeleBot (импорт aiohttp и async_telebot), перед опросом.
+    """
+    executor = ThreadPoolExecutor(max_workers=ROSTER_WORKERS, thread_name_prefix='roster')
+    async_bot, loader = create_async_bot(executor)
+    try:
+        await loader.get()
+        if init_started is not None:
+            startup_timings['bot_init'] = time.perf_counter() - init_started
+        log_startup_report()
+        logger.info("Бот готов к работе. Ожидание команд...")
+        await async_bot.infinity_polling()
+    finally:
+        await async_bot.close_session()
+        executor.shutdown(wait=False)
+
+# ================== ВЕБХУК ==================
+class WebhookHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # по умолчанию 5 - при всплеске соединения сбрасываются
+
+class WebhookServer:
+    """Встроенный HTTP сервер для приема обновлений от Telegram.
+
+    HTTP потоки только проверяют запрос и кладут обновление в
+    ограниченную очередь; обработчики команд выполняет пул из workers
+    потоков. Если очередь заполнена, сервер отвечает 503 - Telegram
+    повторит доставку позже, а бот не копит необработанные обновления.
+    """
+
+    def __init__(self, telegram_bot, host=WEBHOOK_HOST, port=WEBHOOK_PORT, path=WEBHOOK_PATH,
+                 secret=WEBHOOK_SECRET, workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE):
+        self._bot = telegram_bot
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret = secret
+        self.workers = workers
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._server = None
+        self._lock = threading.Lock()
+        self.counts = Counter()
+
+    def _count(self, result):
+        with self._lock:
+            self.counts[result] += 1
+        metrics.inc('bot_webhook_updates_total', result=result)
+
+    def submit(self, body, secret=''):
+        """Принять тело POST запроса: HTTP статус ответа"""
+        if self.secret and not hmac.compare_digest(secret.encode(), self.secret.encode()):
+            self._count('forbidden')
+            return 403
+        try:
+            update = types.Update.de_json(body.decode('utf-8'))
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Вебхук: неразборчивое обновление: {e}")
+            self._count('invalid')
+            return 400
+        
+        try:
+            self._queue.put_nowait((time.perf_counter(), update))
+        except queue.Full:
+            self._count('rejected')
+            return 503
+        self._count('accepted')
+        return 200
+
+    def _work(self):
+        while True:
+            queued_at, update = self._queue.get()
+            metrics.observe('bot_webhook_queue_seconds', time.perf_counter() - queued_at)
+            try:
+                self._bot.process_new_updates([update])
+            except Exception as e:
+                logger.error(f"Ошибка обработки обновления {update.update_id}: {e}")
+            finally:
+                self._queue.task_done()
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self.counts)
+        return {'queue': self._queue.qsize(), 'queue_size': self._queue.maxsize,
+                'workers': self.workers, **counts}
+
+    def start(self):
+        """Запустить пул обработчиков и HTTP сервер (в фоновых потоках)"""
+        # Обработчики выполняются прямо в потоках пула, без внутренней очереди TeleBot
+        self._bot.threaded = False
+        for i in range(self.workers):
+            threading.Thread(target=self._work, name=f'webhook-{i}', daemon=True).start()
         
-        msg = "📋 *Все дни рождения из файла:*\n\n"
+        webhook = self
         
-        current_month = None
-        for person in people_with_birthdays:
-            month = person['birthday'].month
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
             
-            if month != current_month:
-                current_month = month
-                month_name = person['birthday'].strftime('%B')  # Название месяца
-                msg += f"*{month_name.upper()}:*\n"
+            def _respond(self, status, body=b'', content_type='text/plain'):
+                self.send_response(status)
+                if status == 503:
+                    self.send_header('Retry-After', '1')
+                if self.close_connection:
+                    self.send_header('Connection', 'close')
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
             
-            age = datetime.now().year - person['birthday'].year
-            age_text = format_age(age)
-            date_str = person['birthday'].strftime('%d.%m')
+            def do_POST(self):
+                try:
+                    length = int(self.headers.get('Content-Length') or 0)
+                except ValueError:
+                    length = -1
+                if not 0 <= length <= WEBHOOK_MAX_BODY:
+                    # Тело не читаем: соединение закрывается вместе с непрочитанным остатком
+                    self.close_connection = True
+                    webhook._count('too_large' if length > 0 else 'invalid')
+                    self._respond(413 if length > 0 else 400)
+                    return
+                body = self.rfile.read(length)
+                if self.path.split('?', 1)[0] != webhook.path:
+                    self._respond(404)
+                    return
+                self._respond(webhook.submit(body, self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')))
             
-            msg += f"• {person['name']} - {date_str} ({age_text})\n"
-    
-    bot.reply_to(message, msg, parse_mode='Markdown')
+            def do_GET(self):
+                if self.path.split('?', 1)[0] != '/healthz':
+                    self._respond(404)
+                    return
+                self._respond(200, json.dumps(webhook.stats()).encode(), 'application/json')
+            
+            def log_message(self, format, *args):
+                pass
+        
+        self._server = WebhookHTTPServer((self.host, self.port), Handler)
+        self.port = self._server.server_port
+        threading.Thread(target=self._server.serve_forever, name='webhook', daemon=True).start()
+        logger.info(f"🌐 Вебхук слушает http://{self.host}:{self.port}{self.path} "
+                    f"({self.workers} обработчиков, очередь {self._queue.maxsize})")
+        return self
 
-@bot.message_handler(commands=['count'])
-def count_command(message):
-    """Статистика по файлу"""
-    people, df, fio_col, date_col = load_excel_data()
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+webhook_server = WebhookServer(bot)
+
+@metrics.collector
+def webhook_metrics():
+    return [('bot_webhook_queue_depth', 'gauge', [({}, webhook_server.stats()['queue'])])]
+
+def run_webhook():
+    """Запуск бота в режиме вебхука (блокирует поток)"""
+    webhook_server.start()
+    if WEBHOOK_URL:
+        bot.remove_webhook()
+        bot.set_webhook(url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET or None,
+                        max_connections=min(100, max(1, WEBHOOK_WORKERS)))
+        logger.info(f"Telegram будет присылать обновления на {WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH}")
+    threading.Event().wait()
+
+# ================== ОЧЕРЕДЬ ОТЧЕТОВ ==================
+class Outbox:
+    """Очередь ежедневных отчетов в SQLite (WAL).
+
+    digests - текст отчета за местную дату (один раз сформированный
+    отчет больше не меняется). outbox - строка на (чат, дата) с
+    состоянием доставки: pending -> sending -> sent / failed.
+
+    Рассылка забирает строки пачками: атомарный UPDATE pending ->
+    sending в BEGIN IMMEDIATE, так что одну строку не заберут два
+    потока или два процесса. Результаты пачки записываются одной
+    транзакцией. Если процесс упал посреди пачки, ее строки остаются
+    в sending; после OUTBOX_LEASE они помечаются unknown и повторно не
+    отправляются - дубль хуже, чем одно неизвестное сообщение.
+    """
+
+    def __init__(self, path, lease=OUTBOX_LEASE):
+        self.path = path
+        self.lease = lease
+        self._lock = threading.Lock()
+        self._token = f"{os.getpid()}-{os.urandom(4).hex()}"
+        self._db = None
+
+    def _connect(self):
+        if self._db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS digests (
+                    digest_date TEXT PRIMARY KEY,
+                    text TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS outbox (
+                    chat_id TEXT NOT NULL,
+                    digest_date TEXT NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    claimed_by TEXT,
+                    claimed_at REAL,
+                    sent_at REAL,
+                    error TEXT,
+                    PRIMARY KEY (chat_id, digest_date)
+                );
+                CREATE INDEX IF NOT EXISTS outbox_state ON outbox (state, digest_date);
+            """)
+            self._db = db
+        return self._db
+
+    @contextmanager
+    def _write(self):
+        """Транзакция с блокировкой записи (BEGIN IMMEDIATE)"""
+        with self._lock:
+            db = self._connect()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+    def add_digest(self, digest_date, text, chat_ids):
+        """Записать отчет за дату и поставить его в очередь чатам (повторно - без изменений)"""
+        key = digest_date.isoformat()
+        with self._write() as db:
+            db.execute("INSERT OR IGNORE INTO digests (digest_date, text, created_at) VALUES (?, ?, ?)",
+                       (key, text, time.time()))
+            db.executemany("INSERT OR IGNORE INTO outbox (chat_id, digest_date) VALUES (?, ?)",
+                           [(str(chat_id), key) for chat_id in chat_ids])
+
+    def claim(self, digest_date, limit=OUTBOX_BATCH):
+        """Забрать до limit неотправленных сообщений за дату: [(chat_id, текст), ...]"""
+        key = digest_date.isoformat()
+        now = time.time()
+        with self._write() as db:
+            db.execute(
+                "UPDATE outbox SET state = 'sending', claimed_by = ?, claimed_at = ? "
+                "WHERE rowid IN (SELECT rowid FROM outbox WHERE digest_date = ? AND state = 'pending' LIMIT ?)",
+                (self._token, now, key, limit))
+            return db.execute(
+                "SELECT o.chat_id, d.text FROM outbox o JOIN digests d USING (digest_date) "
+                "WHERE o.digest_date = ? AND o.state = 'sending' AND o.claimed_by = ? AND o.claimed_at = ?",
+                (key, self._token, now)).fetchall()
+
+    def start(self, digest_date, chat_id):
+        """Отметить попытку отправки захваченного сообщения (непосредственно перед ней)"""
+        with self._write() as db:
+            db.execute(
+                "UPDATE outbox SET attempts = attempts + 1 WHERE chat_id = ? AND digest_date = ? AND claimed_by = ?",
+                (str(chat_id), digest_date.isoformat(), self._token))
+
+    def finish(self, digest_date, chat_ids, errors):
+        """Записать результат пачки: errors - {chat_id: текст ошибки} для недоставленных"""
+        key = digest_date.isoformat()
+        now = time.time()
+        with self._write() as db:
+            db.executemany(
+                "UPDATE outbox SET state = 'sent', sent_at = ?, error = NULL "
+                "WHERE chat_id = ? AND digest_date = ? AND claimed_by = ?",
+                [(now, str(chat_id), key, self._token) for chat_id in chat_ids if chat_id not in errors])
+            db.executemany(
+                "UPDATE outbox SET state = 'failed', error = ? "
+                "WHERE chat_id = ? AND digest_date = ? AND claimed_by = ?",
+                [(str(error), str(chat_id), key, self._token) for chat_id, error in errors.items()])
+
+    def _expire_leases(self, db):
+        """Захваты старше OUTBOX_LEASE (отправитель прервался): начатые -> unknown,
+        не начатые -> обратно в pending. Возвращает число прерванных отправок.
+        """
+        stale = time.time() - self.lease
+        db.execute(
+            "UPDATE outbox SET state = 'pending', claimed_by = NULL, claimed_at = NULL "
+            "WHERE state = 'sending' AND claimed_at < ? AND attempts = 0", (stale,))
+        return db.execute(
+            "UPDATE outbox SET state = 'unknown' WHERE state = 'sending' AND claimed_at < ?",
+            (stale,)).rowcount
+
+    @staticmethod
+    def _log_interrupted(interrupted):
+        if interrupted:
+            logger.warning(f"Очередь отчетов: {interrupted} сообщений прерваны при отправке, "
+                           f"повторно не отправляются")
+
+    def reclaim(self):
+        """Освободить просроченные захваты без перезапуска (перед каждым проходом рассылки).
+
+        recover() при старте их не видит, если бот перезапустился раньше, чем истек OUTBOX_LEASE.
+        """
+        with self._write() as db:
+            interrupted = self._expire_leases(db)
+        self._log_interrupted(interrupted)
+        return interrupted
+
+    def recover(self):
+        """После перезапуска: прерванные захваты -> unknown, старые pending -> expired.
+
+        Возвращает даты, за которые остались неотправленные отчеты.
+        """
+        today = date.today()
+        with self._write() as db:
+            interrupted = self._expire_leases(db)
+            # Отчет за позавчера и раньше уже неактуален
+            expired = db.execute(
+                "UPDATE outbox SET state = 'expired' WHERE state = 'pending' AND digest_date < ?",
+                ((today - timedelta(days=1)).isoformat(),)).rowcount
+            forget = (today - timedelta(days=OUTBOX_KEEP_DAYS)).isoformat()
+            db.execute("DELETE FROM outbox WHERE digest_date < ?", (forget,))
+            db.execute("DELETE FROM digests WHERE digest_date < ?", (forget,))
+            pending = db.execute(
+                "SELECT DISTINCT digest_date FROM outbox WHERE state = 'pending' ORDER BY digest_date").fetchall()
+        
+        self._log_interrupted(interrupted)
+        if expired:
+            logger.warning(f"Очередь отчетов: {expired} устаревших отчетов не будут отправлены")
+        return [date.fromisoformat(key) for key, in pending]
+
+    def stats(self):
+        """Число строк очереди по состояниям"""
+        with self._lock:
+            rows = self._connect().execute("SELECT state, COUNT(*) FROM outbox GROUP BY state").fetchall()
+        return dict(rows)
+
+outbox = Outbox(OUTBOX_FILE)
+
+@metrics.collector
+def outbox_metrics():
+    return [('bot_outbox_messages', 'gauge',
+             [({'state': state}, count) for state, count in sorted(outbox.stats().items())])]
+
+def deliver_outbox(digest_date):
+    """Разослать все неотправленные отчеты за дату пачками по OUTBOX_BATCH"""
+    outbox.reclaim()
+    sent = failed = 0
+    while True:
+        batch = outbox.claim(digest_date)
+        if not batch:
+            break
+        # Попытка отмечается перед отправкой каждого сообщения: после сбоя
+        # в unknown уйдут только те, что действительно были в полете
+        report = broadcaster.broadcast(batch, on_start=functools.partial(outbox.start, digest_date))
+        outbox.finish(digest_date, [chat_id for chat_id, _ in batch], report['errors'])
+        sent += report['sent']
+        failed += report['failed']
+    return sent, failed
+
+# ================== АВТОМАТИЧЕСКИЕ УВЕДОМЛЕНИЯ ==================
+def render_daily_report(today=None):
+    """Текст ежедневного отчета (today - местная дата чата)"""
+    today = today or datetime.now()
+    today_str = today.strftime('%d.%m.%Y')
     
-    if df is None:
-        msg = "❌ Файл Excel не найден или поврежден"
+    # Получаем данные
+    today_birthdays = get_today_birthdays(today)
+    tomorrow_birthdays = get_tomorrow_birthdays(today)
+    after_tomorrow_birthdays = get_after_tomorrow_birthdays(today)
+    
+    # Формируем сообщение
+    msg = f"📅 *Ежедневный отчет о днях рождения*\n"
+    msg += f"*Дата:* {today_str}\n\n"
+    
+    # Сегодня
+    if today_birthdays:
+        msg += "🎂 *СЕГОДНЯ:*\n"
+        msg += format_birthday_list(today_birthdays)
+        msg += "\n\n"
     else:
-        total_rows = len(df)
-        total_people = len(people)
-        people_with_dates = len([p for p in people if p['birthday']])
-        
-        msg = f"📊 *Статистика файла:*\n\n"
-        msg += f"• Файл: `{EXCEL_FILE}`\n"
-        msg += f"• Всего строк: {total_rows}\n"
-        msg += f"• Распознано людей: {total_people}\n"
-        msg += f"• С датой рождения: {people_with_dates}\n"
-        
-        if fio_col and date_col:
-            msg += f"• Колонка ФИО: `{fio_col}`\n"
-            msg += f"• Колонка дат: `{date_col}`\n"
-        
-        # Самые близкие дни рождения
-        upcoming = get_upcoming_birthdays(30)[:5]  # Ближайшие 5 ДР в течение месяца
-        if upcoming:
-            msg += f"\n*Ближайшие дни рождения:*\n"
-            for b in upcoming:
-                date = datetime.now() + timedelta(days=b['days_until'])
-                age_text = format_age(b['age'])
-                msg += f"• {b['name']} - {date.strftime('%d.%m')} ({age_text})\n"
+        msg += "✅ *Сегодня дней рождения нет*\n\n"
     
-    bot.reply_to(message, msg, parse_mode='Markdown')
-
-@bot.message_handler(commands=['debug'])
-def debug_command(message):
-    """Отладочная информация"""
-    people, df, fio_col, date_col = load_excel_data()
+    # Завтра
+    if tomorrow_birthdays:
+        msg += "🎁 *ЗАВТРА:*\n"
+        msg += format_birthday_list(tomorrow_birthdays)
+        msg += "\n\n"
+    else:
+        msg += "✅ *Завтра дней рождения нет*\n\n"
     
-    if df is None:
-        msg = "❌ Файл не найден"
+    # Послезавтра
+    if after_tomorrow_birthdays:
+        msg += "📅 *ПОСЛЕЗАВТРА:*\n"
+        msg += format_birthday_list(after_tomorrow_birthdays)
+        msg += "\n\n"
     else:
-        msg = f"🔍 *Отладочная информация:*\n\n"
-        msg += f"• Файл: {EXCEL_FILE}\n"
-        msg += f"• Размер: {os.path.getsize(EXCEL_FILE) / 1024:.1f} KB\n"
-        msg += f"• Листы: {df.sheet_names if hasattr(df, 'sheet_names') else 'N/A'}\n"
-        
-        if hasattr(df, 'columns'):
-            msg += f"\n*Колонки в DataFrame:*\n"
-            for i, col in enumerate(df.columns):
-                msg += f"{i+1}. `{col}`\n"
-        
-        if people:
-            msg += f"\n*Первые 5 записей:*\n"
-            for i, person in enumerate(people[:5]):
-                birthday_str = person['birthday'].strftime('%d.%m.%Y') if person['birthday'] else 'НЕТ'
-                msg += f"{i+1}. {person['name']} - {birthday_str}\n"
+        msg += "✅ *Послезавтра дней рождения нет*\n\n"
     
-    bot.reply_to(message, msg, parse_mode='Markdown')
+    msg += "_Используйте /today для деталей_"
+    return msg
 
-# ================== АВТОМАТИЧЕСКИЕ УВЕДОМЛЕНИЯ ==================
-def send_daily_notification():
-    """Отправить ежедневное уведомление"""
+def send_daily_notification(chat_ids=None, today=None):
+    """Отправить ежедневное уведомление (по умолчанию - админу и всем подписчикам)"""
     try:
         logger.info("Отправка ежедневного уведомления...")
         
-        today = datetime.now()
-        today_str = today.strftime('%d.%m.%Y')
-        
-        # Получаем данные
-        today_birthdays = get_today_birthdays()
-        tomorrow_birthdays = get_tomorrow_birthdays()
-        after_tomorrow_birthdays = get_after_tomorrow_birthdays()
-        
-        # Формируем сообщение
-        msg = f"📅 *Ежедневный отчет о днях рождения*\n"
-        msg += f"*Дата:* {today_str}\n\n"
+        today = today or date.today()
+        msg = response_cache.get('daily', lambda: render_daily_report(today), day=today)
         
-        # Сегодня
-        if today_birthdays:
-            msg += "🎂 *СЕГОДНЯ:*\n"
-            msg += format_birthday_list(today_birthdays)
-            msg += "\n\n"
-        else:
-            msg += "✅ *Сегодня дней рождения нет*\n\n"
-        
-        # Завтра
-        if tomorrow_birthdays:
-            msg += "🎁 *ЗАВТРА:*\n"
-            msg += format_birthday_list(tomorrow_birthdays)
-            msg += "\n\n"
-        else:
-            msg += "✅ *Завтра дней рождения нет*\n\n"
-        
-        # Послезавтра
-        if after_tomorrow_birthdays:
-            msg += "📅 *ПОСЛЕЗАВТРА:*\n"
-            msg += format_birthday_list(after_tomorrow_birthdays)
-            msg += "\n\n"
-        else:
-            msg += "✅ *Послезавтра дней рождения нет*\n\n"
-        
-        msg += "_Используйте /today для деталей_"
+        if chat_ids is None:
+            chat_ids = subscribers.chat_ids()
+            if ADMIN_CHAT_ID and str(ADMIN_CHAT_ID) not in chat_ids:
+                chat_ids.append(str(ADMIN_CHAT_ID))
         
-        # Отправляем админу
-        if ADMIN_CHAT_ID:
-            try:
-                bot.send_message(ADMIN_CHAT_ID, msg, parse_mode='Markdown')
-                logger.info(f"Уведомление отправлено админу {ADMIN_CHAT_ID}")
-            except Exception as e:
-                logger.error(f"Ошибка отправки админу: {e}")
+        # Через очередь: уже доставленный за эту дату отчет повторно не уйдет
+        outbox.add_digest(today, msg, chat_ids)
+        sent, failed = deliver_outbox(today)
         
-        logger.info("Ежедневное уведомление сформировано")
+        logger.info(f"Ежедневное уведомление за {today}: отправлено {sent}, ошибок {failed}")
         
     except Exception as e:
         logger.error(f"Ошибка в send_daily_notification: {e}")
 
-def schedule_checker():
-    """Запуск планировщика"""
-    schedule.every().day.at(NOTIFICATION_TIME).do(send_daily_notification)
+def parse_delivery_time(value):
+    """Проверить и нормализовать время вида ЧЧ:ММ"""
+    parsed = datetime.strptime(value, '%H:%M')
+    return parsed.strftime('%H:%M')
+
+def load_timezone(name):
+    """Часовой пояс по имени IANA или None"""
+    from zoneinfo import ZoneInfo
+    try:
+        return ZoneInfo(name)
+    except (ValueError, KeyError, OSError):
+        # OSError: имя каталога базы (Europe, America) - IsADirectoryError
+        return None
+
+def next_delivery(delivery_time, tz_name, after_date=None):
+    """Ближайшая доставка: (UTC timestamp, местная дата).
+
+    Если after_date задана - доставка за следующую местную дату, но не
+    раньше сегодняшней: после долгого простоя или перевода часов вперед
+    устаревшие дни не догоняются, а сегодняшний отчет, если его время
+    уже прошло, уходит сразу. Без after_date - ближайшая еще не
+    наступившая доставка.
+    """
+    tz = load_timezone(tz_name) or timezone.utc
+    hour, minute = map(int, delivery_time.split(':'))
+    today = datetime.now(tz).date()
     
-    logger.info(f"Планировщик запущен. Уведомления в {NOTIFICATION_TIME} UTC")
+    if after_date is not None:
+        local_date = max(after_date + timedelta(days=1), today)
+        due = datetime.combine(local_date, dt_time(hour, minute), tzinfo=tz).timestamp()
+        return due, local_date
     
+    local_date = today
     while True:
-        schedule.run_pending()
-        time.sleep(60)
+        due = datetime.combine(local_date, dt_time(hour, minute), tzinfo=tz).timestamp()
+        if due > time.time():
+            return due, local_date
+        local_date += timedelta(days=1)
+
+class DeliveryScheduler:
+    """Планировщик ежедневных отчетов на куче.
+
+    В куче лежит по одной записи на чат: (время доставки UTC, №, чат,
+    поколение). Поток спит до ближайшей доставки (не дольше
+    SCHEDULER_MAX_SLEEP, чтобы заметить перевод системных часов), затем
+    забирает все наступившие записи и ставит каждому чату следующую
+    доставку - на следующую местную дату. Поэтому при переводе часов
+    вперед пропущенные отчеты отправляются сразу, а при переводе назад
+    один и тот же день не отправляется дважды. Изменение настроек чата
+    повышает его поколение, старая запись в куче просто пропускается.
+    """
+
+    def __init__(self, deliver):
+        # deliver(local_date, [chat_id, ...]) - отправка отчетов
+        self._deliver = deliver
+        self._heap = []
+        self._generations = {}
+        self._counter = 0
+        self._condition = threading.Condition()
+
+    def schedule(self, chat_id, delivery_time, tz_name, after_date=None):
+        """Поставить (или переставить) доставку для чата"""
+        due, local_date = next_delivery(delivery_time, tz_name, after_date)
+        with self._condition:
+            generation = self._generations.get(chat_id, 0) + 1
+            self._generations[chat_id] = generation
+            self._counter += 1
+            heapq.heappush(self._heap, (due, self._counter, chat_id, generation,
+                                        local_date, delivery_time, tz_name))
+            self._condition.notify()
+
+    def unschedule(self, chat_id):
+        """Убрать чат из расписания"""
+        with self._condition:
+            self._generations.pop(chat_id, None)
+
+    def __len__(self):
+        with self._condition:
+            return len(self._generations)
+
+    def _pop_due(self):
+        """Дождаться и забрать все наступившие доставки"""
+        with self._condition:
+            while True:
+                # Отмененные и переставленные записи
+                while self._heap and self._generations.get(self._heap[0][2]) != self._heap[0][3]:
+                    heapq.heappop(self._heap)
+                
+                now = time.time()
+                if self._heap and self._heap[0][0] <= now:
+                    due = []
+                    while self._heap and self._heap[0][0] <= now:
+                        entry = heapq.heappop(self._heap)
+                        if self._generations.get(entry[2]) == entry[3]:
+                            due.append(entry)
+                    return due
+                
+                timeout = SCHEDULER_MAX_SLEEP
+                if self._heap:
+                    timeout = min(timeout, self._heap[0][0] - now)
+                self._condition.wait(timeout)
+
+    def run(self):
+        """Основной цикл (в отдельном потоке)"""
+        while True:
+            due = self._pop_due()
+            
+            # Один отчет на местную дату - для всех чатов с этой датой
+            by_date = {}
+            for due_at, _, chat_id, _, local_date, delivery_time, tz_name in due:
+                by_date.setdefault(local_date, []).append((chat_id, due_at))
+                self.schedule(chat_id, delivery_time, tz_name, after_date=local_date)
+            
+            for local_date, entries in by_date.items():
+                try:
+                    self._deliver(local_date, [chat_id for chat_id, _ in entries])
+                except Exception as e:
+                    logger.error(f"Ошибка доставки отчета за {local_date}: {e}")
+                    continue
+                # Опоздание - до завершения рассылки (очередь отчетов и отправка включены)
+                finished = time.time()
+                for chat_id, due_at in entries:
+                    lag = finished - due_at
+                    metrics.observe('bot_scheduler_lag_seconds', lag)
+                    if lag > 60:
+                        logger.warning(f"Доставка в {chat_id} за {local_date} опоздала на {lag:.0f} с")
+
+scheduler = DeliveryScheduler(lambda local_date, chat_ids: send_daily_notification(chat_ids, local_date))
+
+@metrics.collector
+def scheduler_metrics():
+    return [('bot_scheduled_chats', 'gauge', [({}, len(scheduler))])]
+
+def local_yesterday(tz_name):
+    """Вчерашняя дата в часовом поясе чата"""
+    tz = load_timezone(tz_name) or timezone.utc
+    return datetime.now(tz).date() - timedelta(days=1)
+
+def schedule_checker():
+    """Запуск планировщика.
+
+    Сначала досылаются отчеты, оставшиеся в очереди с прошлого запуска.
+    Затем каждому чату ставится доставка за сегодня: если ее время уже
+    прошло (бот не работал), отчет уходит сразу, а если он уже был
+    доставлен, очередь его не повторит.
+    """
+    for digest_date in outbox.recover():
+        sent, failed = deliver_outbox(digest_date)
+        logger.info(f"Досланы отчеты за {digest_date}: {sent}, ошибок {failed}")
+    
+    for chat_id in subscribers.chat_ids():
+        delivery_time, tz_name = subscribers.settings(chat_id)
+        scheduler.schedule(chat_id, delivery_time, tz_name, after_date=local_yesterday(tz_name))
+    
+    # Админ получает отчет по умолчанию, если не подписан с другими настройками
+    if ADMIN_CHAT_ID and str(ADMIN_CHAT_ID) not in subscribers:
+        scheduler.schedule(str(ADMIN_CHAT_ID), NOTIFICATION_TIME, NOTIFICATION_TZ,
+                           after_date=local_yesterday(NOTIFICATION_TZ))
+    
+    logger.info(f"Планировщик запущен: {len(scheduler)} чатов, по умолчанию в {NOTIFICATION_TIME} {NOTIFICATION_TZ}")
+    scheduler.run()
 
 # ================== ЗАПУСК БОТА ==================
+@metrics.collector
+def startup_metrics():
+    return [('bot_startup_seconds', 'gauge',
+             [({'phase': name}, seconds) for name, seconds in startup_timings.items()])]
+
+def log_startup_report():
+    """Записать в лог время до первого опроса по фазам"""
+    total = time.perf_counter() - STARTUP_STARTED
+    phases = ", ".join(f"{name} {seconds * 1000:.0f} мс" for name, seconds in startup_timings.items())
+    logger.info(f"⏱ До первого опроса: {total * 1000:.0f} мс ({phases})")
+
 def main():
     """Основная функция"""
     logger.info("🚀 Запуск Excel Birthday Bot...")
     
-    # Проверяем наличие Excel файла
-    if not os.path.exists(EXCEL_FILE):
-        logger.error(f"Файл {EXCEL_FILE} не найден!")
+    if not BOT_TOKEN:
+        logger.error("Не задана переменная окружения BOT_TOKEN")
+        return
+    
+    if metrics.enabled:
+        instrument_telegram_api()
+        start_metrics_server()
+    
+    # Проверяем наличие Excel файлов
+    if not resolve_sources():
+        logger.error(f"Файл {EXCEL_SOURCES} не найден!")
         if ADMIN_CHAT_ID:
             bot.send_message(ADMIN_CHAT_ID, 
-                           f"❌ Файл `{EXCEL_FILE}` не найден!\n"
+                           f"❌ Файл `{EXCEL_SOURCES}` не найден!\n"
                            "Загрузите его в корень репозитория.")
         return
     
     # Загружаем данные
-    people, df, fio_col, date_col = load_excel_data()
+    phase_started = time.perf_counter()
+    roster = get_roster()
+    startup_timings['roster'] = time.perf_counter() - phase_started
     
-    if df is not None:
-        logger.info(f"Загружено {len(people)} записей из Excel")
+    phase_started = time.perf_counter()
+    if roster is not None:
+        logger.info(f"Загружено {len(roster)} записей из Excel")
         
         # Отправляем сообщение админу о запуске
         if ADMIN_CHAT_ID:
@@ -548,7 +3660,7 @@ def main():
                 bot.send_message(
                     ADMIN_CHAT_ID,
                     f"✅ *Excel Birthday Bot запущен!*\n\n"
-                    f"📊 Загружено: {len(people)} записей\n"
+                    f"📊 Загружено: {len(roster)} записей\n"
                     f"⏰ Уведомления: каждый день в {NOTIFICATION_TIME} UTC\n"
                     f"📅 Ближайшие ДР: {len(get_upcoming_birthdays(7))} в ближайшие 7 дней",
                     parse_mode='Markdown'
@@ -556,14 +3668,104 @@ def main():
             except:
                 pass
     
+    # Индекс имен для /find строится в фоне, чтобы не задерживать запуск
+    threading.Thread(target=warm_roster, name='warm-indexes', daemon=True).start()
+    
+    # Дальше файл перечитывается в фоне при изменении
+    if WATCH_ROSTER:
+        roster_watcher.start()
+    
     # Запускаем планировщик
     scheduler_thread = threading.Thread(target=schedule_checker, daemon=True)
     scheduler_thread.start()
     
+    # Запускаем бота
+    if BOT_MODE == 'async':
+        # Отчет о запуске пишет run_async_bot, когда AsyncTeleBot уже создан
+        import asyncio
+        asyncio.run(run_async_bot(phase_started))
+        return
+    
+    startup_timings['bot_init'] = time.perf_counter() - phase_started
+    log_startup_report()
     logger.info("Бот готов к работе. Ожидание команд...")
     
-    # Запускаем бота
-    bot.infinity_polling()
+    if BOT_MODE == 'webhook':
+        run_webhook()
+    else:
+        bot.infinity_polling()
 
-if __name__ == "__main__":
+def build_snapshot_command(args):
+    """Собрать снимок ростера без запуска бота"""
+    paths = resolve_sources(args.excel)
+    output = args.output or (args.excel + '.snapshot' if len(source_patterns(args.excel)) == 1 else SNAPSHOT_FILE)
+    if not paths:
+        logger.error(f"Файл {args.excel} не найден!")
+        return 1
+    
+    started = time.perf_counter()
+    roster = load_sources(paths)
+    if roster is None:
+        return 1
+    write_snapshot(roster, output, sources_digest(paths))
+    logger.info(f"Готово за {time.perf_counter() - started:.2f} с")
+    return 0
+
+def export_calendar_command(args):
+    """Выгрузить дни рождения в файл без запуска бота"""
+    paths = resolve_sources(args.excel)
+    if not paths:
+        logger.error(f"Файл {args.excel} не найден!")
+        return 1
+    
+    started = time.perf_counter()
+    roster = load_sources(paths)
+    if roster is None:
+        return 1
+    
+    sources = None
+    if args.department:
+        sources = department_sources(roster, args.department)
+        if not sources:
+            logger.error(f"Отдел {args.department} не найден")
+            return 1
+    
+    chunks = EXPORTERS[args.format](roster, sources)
+    output = args.output or f"birthdays.{args.format}"
+    if output == '-':
+        for chunk in chunks:
+            sys.stdout.buffer.write(chunk.encode('utf-8'))
+        sys.stdout.buffer.flush()
+    else:
+        os.replace(write_export(chunks, args.format), output)
+        logger.info(f"Выгрузка записана в {output} за {time.perf_counter() - started:.2f} с")
+    return 0
+
+def cli(argv=None):
+    """Точка входа командной строки"""
+    parser = argparse.ArgumentParser(description="Excel Birthday Bot")
+    commands = parser.add_subparsers(dest='command')
+    
+    snapshot_parser = commands.add_parser('build-snapshot', help="собрать снимок ростера из Excel")
+    snapshot_parser.add_argument('--excel', default=EXCEL_SOURCES,
+                                 help="исходные Excel файлы и маски через запятую")
+    snapshot_parser.add_argument('--output', help="файл снимка (по умолчанию <excel>.snapshot)")
+    
+    export_parser = commands.add_parser('export', help="выгрузить дни рождения в .ics или .csv")
+    export_parser.add_argument('--format', choices=EXPORT_FORMATS, default=EXPORT_FORMATS[0])
+    export_parser.add_argument('--output', help="файл (по умолчанию birthdays.<формат>, '-' - stdout)")
+    export_parser.add_argument('--department', help="только отдел (часть имени файла или листа)")
+    export_parser.add_argument('--excel', default=EXCEL_SOURCES,
+                               help="исходные Excel файлы и маски через запятую")
+    
+    args = parser.parse_args(argv)
+    if args.command == 'build-snapshot':
+        return build_snapshot_command(args)
+    if args.command == 'export':
+        return export_calendar_command(args)
+    
     main()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(cli())
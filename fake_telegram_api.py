@@ -0,0 +1,560 @@
+#!/usr/bin/env python3
+"""
+🧪 Локальная замена Telegram Bot API для нагрузочного тестирования
+
+Сервер отдает боту через getUpdates заранее подготовленный (из файла)
+или случайный поток команд, записывает все sendMessage и прочие
+ответы бота и умеет имитировать сбои: ответы 429 с retry_after и
+задержку каждого запроса.
+
+    # Только сервер: бот запускается отдельно
+    python fake_telegram_api.py serve --port 8081 --count 1000
+    TELEGRAM_API_URL=http://127.0.0.1:8081/bot{0}/{1} BOT_TOKEN=1:fake python bot.py
+
+    # Нагрузочный прогон: сервер + бот в отдельном процессе + отчет
+    python fake_telegram_api.py load --count 2000 --chats 50 --fault-429 0.01
+    # То же, но обновления приходят боту POST запросами на вебхук
+    python fake_telegram_api.py load --count 2000 --webhook
+
+Формат сценария (--script): по строке на обновление, "[chat_id] текст".
+Текст, начинающийся с "callback:", отправляется как нажатие кнопки
+с данными после префикса, например "42 callback:all:3:0".
+"""
+
+import os
+import argparse
+import json
+import logging
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import socket
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger('fake_telegram_api')
+
+BOT_USER = {'id': 1000000001, 'is_bot': True, 'first_name': 'Birthday Bot', 'username': 'fake_birthday_bot'}
+# Методы, на которые по умолчанию приходят сбои (getUpdates не трогаем - иначе бот просто ждет)
+DEFAULT_FAULT_METHODS = ('sendMessage', 'editMessageText', 'answerCallbackQuery', 'sendDocument')
+MAX_LONG_POLL = 30  # секунд
+
+# Случайный поток: команда и ее вес
+RANDOM_COMMANDS = [
+    ('/today', 5), ('/tomorrow', 3), ('/after_tomorrow', 1), ('/week', 4),
+    ('/all', 2), ('/count', 2), ('/start', 1), ('/find Ив', 1), ('callback:all', 2),
+]
+
+def percentile(sorted_values, p):
+    """Перцентиль по ближайшему рангу (значения уже отсортированы)"""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+def parse_multipart(body, content_type):
+    """Поля multipart/form-data (sendDocument): {имя: значение}, файлы - размером"""
+    message = BytesParser(policy=HTTP).parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode('latin-1') + body)
+    fields = {}
+    for part in message.iter_parts():
+        name = part.get_param('name', header='content-disposition')
+        payload = part.get_payload(decode=True) or b''
+        if part.get_filename():
+            fields[name] = f"<файл {part.get_filename()}, {len(payload)} байт>"
+        else:
+            fields[name] = payload.decode('utf-8', 'replace')
+    return fields
+
+# ================== СЕРВЕР ==================
+class QuietHTTPServer(ThreadingHTTPServer):
+    """HTTP сервер, который не печатает трассировку, когда бот рвет соединение"""
+
+    daemon_threads = True
+    request_queue_size = 128  # по умолчанию 5 - при всплеске соединения бота сбрасываются
+
+    def handle_error(self, request, client_address):
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+class FakeTelegramAPI:
+    """Состояние поддельного Bot API: очередь обновлений, ответы бота, сбои.
+
+    Каждая команда, поставленная в очередь, ждет ответа бота: сообщения -
+    sendMessage с reply_to_message_id, нажатия кнопок - answerCallbackQuery.
+    Время от постановки в очередь до ответа и есть сквозная задержка.
+    """
+
+    def __init__(self, fault_429=0.0, retry_after=1, latency=0.0, jitter=0.0,
+                 fault_methods=DEFAULT_FAULT_METHODS, seed=None):
+        self.fault_429 = fault_429
+        self.retry_after = retry_after
+        self.latency = latency
+        self.jitter = jitter
+        self.fault_methods = set(fault_methods)
+        self._rng = random.Random(seed)
+        self._condition = threading.Condition()
+        self._updates = []
+        self._next_update_id = 1
+        self._next_message_id = 1
+        self._pending = {}  # ('message', message_id) или ('callback', id) -> (время, команда)
+        self.completed = []  # (команда, задержка)
+        self.last_completed = None  # perf_counter() последнего ответа
+        self.calls = []  # все запросы бота, кроме getUpdates
+        self.faults = 0
+        self.polled = threading.Event()
+        self._server = None
+
+    # ---------- поток обновлений ----------
+    def _message_id(self):
+        message_id = self._next_message_id
+        self._next_message_id += 1
+        return message_id
+
+    def _push(self, update, key, command, queued):
+        update['update_id'] = self._next_update_id
+        self._next_update_id += 1
+        if queued:
+            self._updates.append(update)
+        self._pending[key] = (time.perf_counter(), command)
+        self._condition.notify_all()
+        return update
+
+    def enqueue(self, chat_id, text, queued=True):
+        """Поставить в очередь сообщение или нажатие кнопки ("callback:<данные>").
+
+        queued=False - обновление не отдается через getUpdates (его доставят
+        на вебхук), но ответ на него все равно ожидается. Возвращает update.
+        """
+        user = {'id': chat_id, 'is_bot': False, 'first_name': 'Load', 'last_name': str(chat_id)}
+        chat = {'id': chat_id, 'type': 'private', 'first_name': 'Load'}
+        with self._condition:
+            message = {'message_id': self._message_id(), 'date': int(time.time()), 'chat': chat, 'from': user}
+            if text.startswith('callback:'):
+                data = text[len('callback:'):]
+                callback_id = str(self._next_update_id)
+                message.update(text='📋 Все дни рождения', **{'from': BOT_USER})
+                update = {'callback_query': {'id': callback_id, 'from': user, 'chat_instance': str(chat_id),
+                                             'message': message, 'data': data}}
+                return self._push(update, ('callback', callback_id), 'callback:' + data.split(':')[0], queued)
+            else:
+                command = text.split()[0]
+                message['text'] = text
+                if command.startswith('/'):
+                    message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+                return self._push({'message': message}, ('message', message['message_id']), command, queued)
+
+    def pending(self):
+        with self._condition:
+            return len(self._pending)
+
+    def wait_idle(self, timeout, stall=None):
+        """Дождаться ответов на все команды; False по таймауту.
+
+        stall - сколько секунд можно не получать ни одного ответа: ответы,
+        потерянные из-за 429, иначе ждали бы весь timeout.
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            completed = len(self.completed)
+            last_progress = time.monotonic()
+            while self._pending:
+                now = time.monotonic()
+                if len(self.completed) != completed:
+                    completed = len(self.completed)
+                    last_progress = now
+                limit = deadline if stall is None else min(deadline, last_progress + stall)
+                if now >= limit:
+                    return False
+                self._condition.wait(limit - now)
+            return True
+
+    # ---------- методы Bot API ----------
+    def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        timeout = min(float(params.get('timeout') or 0), MAX_LONG_POLL)
+        self.polled.set()
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            # Подтвержденные ботом обновления больше не нужны
+            self._updates = [u for u in self._updates if u['update_id'] >= offset]
+            while not self._updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            return self._updates[:limit]
+
+    def _complete(self, key):
+        """Команда получила ответ (вызывается под блокировкой)"""
+        entry = self._pending.pop(key, None)
+        if entry is not None:
+            started, command = entry
+            self.last_completed = time.perf_counter()
+            self.completed.append((command, self.last_completed - started))
+            self._condition.notify_all()
+
+    def _reply(self, method, params):
+        """Ответ на все методы, кроме getUpdates"""
+        with self._condition:
+            self.calls.append({'method': method, 'at': time.time(), 'params': params})
+
+            if method == 'getMe':
+                return BOT_USER
+            if method in ('sendMessage', 'sendDocument', 'editMessageText'):
+                if params.get('reply_to_message_id'):
+                    self._complete(('message', int(params['reply_to_message_id'])))
+                chat_id = params.get('chat_id') or 0
+                chat = {'id': int(chat_id) if str(chat_id).lstrip('-').isdigit() else 0, 'type': 'private'}
+                message_id = int(params.get('message_id') or 0) or self._message_id()
+                return {'message_id': message_id, 'date': int(time.time()), 'chat': chat,
+                        'from': BOT_USER, 'text': params.get('text', '')}
+            if method == 'answerCallbackQuery':
+                self._complete(('callback', str(params.get('callback_query_id'))))
+            return True
+
+    def handle(self, method, params):
+        """Обработать запрос: (HTTP статус, JSON ответа)"""
+        if method == 'getUpdates':
+            return 200, {'ok': True, 'result': self._get_updates(params)}
+
+        if self.latency or self.jitter:
+            time.sleep(self.latency + self._rng.random() * self.jitter)
+
+        if method in self.fault_methods and self.fault_429 and self._rng.random() < self.fault_429:
+            with self._condition:
+                self.faults += 1
+            return 429, {'ok': False, 'error_code': 429,
+                         'description': f"Too Many Requests: retry after {self.retry_after}",
+                         'parameters': {'retry_after': self.retry_after}}
+
+        return 200, {'ok': True, 'result': self._reply(method, params)}
+
+    # ---------- HTTP ----------
+    def start(self, host='127.0.0.1', port=0):
+        """Запустить HTTP сервер в фоновом потоке; вернуть URL для TELEGRAM_API_URL"""
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True  # иначе keep-alive ответы ждут delayed ACK (~40 мс)
+
+            def _handle(self):
+                url = urlsplit(self.path)
+                method = url.path.rstrip('/').rsplit('/', 1)[-1]
+                params = dict(parse_qsl(url.query))
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                content_type = self.headers.get('Content-Type', '')
+                if body and content_type.startswith('multipart/form-data'):
+                    params.update(parse_multipart(body, content_type))
+                elif body and content_type.startswith('application/json'):
+                    params.update(json.loads(body))
+                elif body:
+                    params.update(parse_qsl(body.decode('utf-8')))
+
+                status, payload = api.handle(method, params)
+                data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = _handle
+            do_POST = _handle
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = QuietHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, name='fake-api', daemon=True).start()
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/bot{{0}}/{{1}}"
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+class WebhookPoster:
+    """Доставка обновлений на вебхук бота, как это делает Telegram.
+
+    На 503 (очередь бота заполнена) ждет Retry-After и повторяет.
+    """
+
+    def __init__(self, url, secret='', workers=16):
+        self.url = url
+        self.secret = secret
+        self.rejected = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='poster')
+
+    def wait_ready(self, timeout):
+        """Дождаться, пока вебхук начнет отвечать (GET /healthz)"""
+        health_url = urlsplit(self.url)._replace(path='/healthz').geturl()
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                with urllib.request.urlopen(health_url, timeout=1):
+                    return True
+            except OSError:
+                time.sleep(0.1)
+        return False
+
+    def _post(self, update):
+        body = json.dumps(update, ensure_ascii=False).encode('utf-8')
+        while True:
+            request = urllib.request.Request(self.url, data=body, headers={
+                'Content-Type': 'application/json',
+                'X-Telegram-Bot-Api-Secret-Token': self.secret,
+            })
+            try:
+                with urllib.request.urlopen(request, timeout=10):
+                    return
+            except urllib.error.HTTPError as e:
+                if e.code != 503:
+                    with self._lock:
+                        self.failed += 1
+                    logger.warning(f"Вебхук ответил {e.code} на обновление {update['update_id']}")
+                    return
+                with self._lock:
+                    self.rejected += 1
+                time.sleep(float(e.headers.get('Retry-After') or 1))
+            except OSError as e:
+                with self._lock:
+                    self.failed += 1
+                logger.warning(f"Не удалось доставить обновление {update['update_id']}: {e}")
+                return
+
+    def submit(self, update):
+        self._pool.submit(self._post, update)
+
+    def close(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+def free_port(host='127.0.0.1'):
+    """Свободный TCP порт для вебхука бота"""
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+# ================== ПОТОК КОМАНД ==================
+def read_script(path, default_chat_id=1):
+    """Сценарий из файла: [(chat_id, текст), ...]"""
+    stream = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            first, _, rest = line.partition(' ')
+            if first.lstrip('-').isdigit() and rest:
+                stream.append((int(first), rest.strip()))
+            else:
+                stream.append((default_chat_id, line))
+    return stream
+
+def random_stream(count, chats, seed=None):
+    """Случайные команды от chats разных пользователей: [(chat_id, текст), ...]"""
+    rng = random.Random(seed)
+    commands, weights = zip(*RANDOM_COMMANDS)
+    stream = []
+    for command in rng.choices(commands, weights, k=count):
+        if command == 'callback:all':
+            command = f"callback:all:{rng.randint(1, 12)}:0"
+        stream.append((rng.randint(1, chats), command))
+    return stream
+
+# ================== НАГРУЗОЧНЫЙ ПРОГОН ==================
+def latency_report(api, sent, elapsed):
+    """Сводка прогона: пропускная способность и перцентили задержки (мс)"""
+    by_command = {}
+    for command, latency in api.completed:
+        by_command.setdefault(command, []).append(latency)
+
+    def summary(latencies):
+        latencies = sorted(latencies)
+        return {
+            'count': len(latencies),
+            **{f"p{p}": round(percentile(latencies, p) * 1000, 2) if latencies else None
+               for p in (50, 95, 99)},
+            'max': round(latencies[-1] * 1000, 2) if latencies else None,
+        }
+
+    completed = len(api.completed)
+    return {
+        'sent': sent,
+        'completed': completed,
+        'lost': sent - completed,
+        'faults_429': api.faults,
+        'elapsed': round(elapsed, 3),
+        'throughput': round(completed / elapsed, 1) if elapsed else 0.0,
+        'latency_ms': summary([latency for _, latency in api.completed]),
+        'commands': {command: summary(latencies) for command, latencies in sorted(by_command.items())},
+    }
+
+def start_bot(api_url, bot_dir, env=None):
+    """Запустить bot.py в отдельном процессе с адресом поддельного API (лог - в файл)"""
+    state_dir = tempfile.mkdtemp(prefix='fake-api-')
+    bot_env = dict(os.environ)
+    bot_env.update({
+        'TELEGRAM_API_URL': api_url,
+        'BOT_TOKEN': '1000000001:FAKE',
+        'ADMIN_CHAT_ID': '',
+        'SUBSCRIBERS_FILE': os.path.join(state_dir, 'subscribers.json'),
+        'SNAPSHOT_FILE': os.path.join(state_dir, 'roster.snapshot'),
+        # Своя очередь отчетов: иначе прогон "доставит" настоящие отчеты в поддельный API
+        'OUTBOX_FILE': os.path.join(state_dir, 'outbox.sqlite3'),
+        'PROFILE_DIR': os.path.join(state_dir, 'profiles'),
+    })
+    bot_env.update(env or {})
+    log_path = os.path.join(state_dir, 'bot.log')
+    logger.info(f"Лог бота: {log_path}")
+    with open(log_path, 'w') as log:
+        return subprocess.Popen([sys.executable, os.path.join(bot_dir, 'bot.py')], cwd=bot_dir, env=bot_env,
+                                stdout=log, stderr=subprocess.STDOUT)
+
+def run_load(api, stream, rate=0.0, timeout=60.0, stall=10.0, startup_timeout=60.0, poster=None):
+    """Отправить поток команд (rate в секунду, 0 - все сразу) и дождаться ответов.
+
+    poster - WebhookPoster: обновления уходят на вебхук, а не в getUpdates.
+    """
+    if poster is None:
+        if not api.polled.wait(startup_timeout):
+            raise RuntimeError("Бот не начал опрос getUpdates")
+    elif not poster.wait_ready(startup_timeout):
+        raise RuntimeError(f"Вебхук {poster.url} не отвечает")
+
+    started = time.perf_counter()
+    for i, (chat_id, text) in enumerate(stream):
+        if rate:
+            delay = started + i / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        update = api.enqueue(chat_id, text, queued=poster is None)
+        if poster is not None:
+            poster.submit(update)
+
+    if not api.wait_idle(timeout, stall):
+        logger.warning(f"Не дождались ответа на {api.pending()} команд")
+    elapsed = (api.last_completed or time.perf_counter()) - started
+    report = latency_report(api, len(stream), elapsed)
+    if poster is not None:
+        report['webhook'] = {'rejected_503': poster.rejected, 'failed': poster.failed}
+    return report
+
+def load_command(args):
+    api = FakeTelegramAPI(args.fault_429, args.retry_after, args.latency / 1000, args.jitter / 1000,
+                          seed=args.seed)
+    stream = read_script(args.script) if args.script else random_stream(args.count, args.chats, args.seed)
+    api_url = api.start(args.host, args.port)
+    logger.info(f"Поддельный Bot API: {api_url}")
+
+    env = dict(value.split('=', 1) for value in args.env)
+    poster = None
+    if args.webhook:
+        port = free_port()
+        secret = os.urandom(8).hex()
+        env.update(BOT_MODE='webhook', WEBHOOK_HOST='127.0.0.1', WEBHOOK_PORT=str(port),
+                   WEBHOOK_PATH='/webhook', WEBHOOK_URL='', WEBHOOK_SECRET=secret)
+        poster = WebhookPoster(f"http://127.0.0.1:{port}/webhook", secret, args.webhook_clients)
+
+    process = start_bot(api_url, args.bot_dir, env)
+    try:
+        report = run_load(api, stream, args.rate, args.timeout, args.stall, poster=poster)
+    finally:
+        if poster is not None:
+            poster.close()
+        process.terminate()
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        api.stop()
+
+    text = json.dumps(report, ensure_ascii=False, indent=1)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    return 0 if report['lost'] == 0 or args.fault_429 else 1
+
+def serve_command(args):
+    api = FakeTelegramAPI(args.fault_429, args.retry_after, args.latency / 1000, args.jitter / 1000,
+                          seed=args.seed)
+    api_url = api.start(args.host, args.port)
+    logger.info(f"Поддельный Bot API: {api_url}")
+    logger.info(f"Запуск бота: TELEGRAM_API_URL='{api_url}' BOT_TOKEN=1000000001:FAKE python bot.py")
+
+    stream = read_script(args.script) if args.script else random_stream(args.count, args.chats, args.seed)
+    api.polled.wait()
+    started = time.perf_counter()
+    for chat_id, text in stream:
+        api.enqueue(chat_id, text)
+    try:
+        while True:
+            time.sleep(5)
+            logger.info(f"Ответов: {len(api.completed)}, ждут ответа: {api.pending()}, "
+                        f"запросов бота: {len(api.calls)}, сбоев 429: {api.faults}")
+    except KeyboardInterrupt:
+        print(json.dumps(latency_report(api, len(stream), time.perf_counter() - started),
+                         ensure_ascii=False, indent=1))
+    finally:
+        api.stop()
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Поддельный Telegram Bot API для нагрузочного тестирования")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    for name, help_text in (('serve', "только сервер"), ('load', "сервер + bot.py + отчет о задержках")):
+        sub = commands.add_parser(name, help=help_text)
+        sub.add_argument('--host', default='127.0.0.1')
+        sub.add_argument('--port', type=int, default=8081 if name == 'serve' else 0)
+        sub.add_argument('--script', help="сценарий команд (по строке на обновление)")
+        sub.add_argument('--count', type=int, default=1000, help="случайных команд, если нет сценария")
+        sub.add_argument('--chats', type=int, default=20, help="разных чатов в случайном потоке")
+        sub.add_argument('--seed', type=int, default=None)
+        sub.add_argument('--fault-429', type=float, default=0.0, help="доля ответов 429 (0..1)")
+        sub.add_argument('--retry-after', type=int, default=1, help="retry_after в ответах 429, с")
+        sub.add_argument('--latency', type=float, default=0.0, help="задержка каждого ответа, мс")
+        sub.add_argument('--jitter', type=float, default=0.0, help="случайная добавка к задержке, мс")
+
+    load_parser = commands.choices['load']
+    load_parser.add_argument('--rate', type=float, default=0.0, help="команд в секунду (0 - все сразу)")
+    load_parser.add_argument('--timeout', type=float, default=60.0, help="сколько ждать ответов, с")
+    load_parser.add_argument('--stall', type=float, default=10.0,
+                             help="закончить, если столько секунд не было ни одного ответа")
+    load_parser.add_argument('--bot-dir', default=os.path.dirname(os.path.abspath(__file__)),
+                             help="каталог с bot.py и Excel файлом")
+    load_parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                             help="переменная окружения для бота (можно несколько раз)")
+    load_parser.add_argument('--webhook', action='store_true',
+                             help="запустить бота с BOT_MODE=webhook и слать обновления POST запросами")
+    load_parser.add_argument('--webhook-clients', type=int, default=16,
+                             help="параллельных POST запросов на вебхук")
+    load_parser.add_argument('--output', help="записать отчет в JSON")
+
+    args = parser.parse_args(argv)
+    if args.command == 'serve':
+        return serve_command(args)
+    return load_command(args)
+
+if __name__ == "__main__":
+    sys.exit(main())